@@ -12,7 +12,9 @@ from scipy.signal import butter, lfilter, deconvolve, cheby1, filtfilt, decimate
 from scipy.signal import *
 from numpy import *
 from pylab import *
+from ExcitationPlan import ExcitationPlan
 from MlsDb import MlsDb
+from SignalGenerator import SignalGenerator
 
 __author__ = "Lance Jenkin"
 __email__ = "lancejenkin@gmail.com"
@@ -52,6 +54,7 @@ class AbsorptionCoefficient(object):
         self.measurement_settings = measurement_settings
         self.analysis_settings = analysis_settings
 
+        self.plan = ExcitationPlan(measurement_settings)
         self.mls_db = MlsDb()
 
         self.determineAlpha()
@@ -108,33 +111,25 @@ class AbsorptionCoefficient(object):
         self.logger.debug("Entering _determineResponse")
 
         # If MLS signal, then utilize the circular convolution property
-        signal_type = self.measurement_settings["signal type"]
-        sample_rate = float(self.measurement_settings["sample rate"])
+        signal_type = self.plan.signal_type
 
-        if signal_type.lower() == "maximum length sequence":
-            number_taps = int(self.measurement_settings["mls taps"])
+        if signal_type == "maximum length sequence":
+            number_taps = self.plan.mls_taps
 
-            self.microphone_response = self.mls_db.getSystemResponse(self.average_microphone_response, number_taps)
+            responses = self.mls_db.getSystemResponses([self.average_microphone_response,
+                                                        self.average_generator_response], number_taps)
 
-            self.generator_response = self.mls_db.getSystemResponse(self.average_generator_response, number_taps)
+            (self.microphone_response, self.generator_response) = responses
 
             self.system_response = ifft(fft(self.microphone_response) / fft(self.generator_response))
 
-        elif signal_type.lower() == "inverse repeat sequence":
-            number_taps = int(self.measurement_settings["mls taps"])
-            # TODO: Re-factor this out of absorption coefficient
-            mls = self.mls_db.getMls(number_taps)
-            mls = -2 * mls + 1
-            irs = array([])
-            for index, sample in enumerate(r_[mls, mls]):
-                if index % 2 == 0:
-                    irs = r_[irs, sample]
-                else:
-                    irs = r_[irs, -1 * sample]
+        elif signal_type == "inverse repeat sequence":
+            number_taps = self.plan.mls_taps
+            irs_spectrum = self.mls_db.getIrsSpectrum(number_taps)
 
-
-            self.microphone_response = irfft(rfft(self.average_microphone_response) * rfft(irs[-1::-1]))
-            self.generator_response = irfft(rfft(self.average_generator_response) * rfft(irs[-1::-1]))
+            responses = irfft(rfft([self.average_microphone_response,
+                                    self.average_generator_response]) * irs_spectrum)
+            (self.microphone_response, self.generator_response) = responses
 
             # The output of the auto-correlation of an irs signal is a + impulse at 0 and a
             # - impulse at N / 2.  One is only interested in the positive impulse, so extract
@@ -143,24 +138,31 @@ class AbsorptionCoefficient(object):
             # start - if the start of the IRS signal is missed, then part of the - impulse
             # response will corrupt the positive impulse response.
 
-            impulse_length = len(mls)
-            window = hanning(0.1 * impulse_length)
+            impulse_length = 2 ** number_taps - 1
+            window = hanning(int(0.1 * impulse_length))
 
-            self.microphone_response = self.microphone_response[:0.9 * impulse_length]
+            self.microphone_response = self.microphone_response[:int(0.9 * impulse_length)]
             self.microphone_response[-len(window) / 2 :] *= window[-len(window) / 2 :]
-            tmp_response = self.microphone_response[-0.1 * impulse_length:]
+            tmp_response = self.microphone_response[-int(0.1 * impulse_length):]
             tmp_response[:len(window) / 2] *= window[:len(window) / 2]
             append(self.microphone_response, tmp_response)
 
-            self.generator_response = self.generator_response[:0.9 * impulse_length]
+            self.generator_response = self.generator_response[:int(0.9 * impulse_length)]
             self.generator_response[-len(window) / 2 :] *= window[-len(window) / 2 :]
-            tmp_response = self.generator_response[-0.1 * impulse_length:]
+            tmp_response = self.generator_response[-int(0.1 * impulse_length):]
             tmp_response[:len(window) / 2] *= window[:len(window) / 2]
             append(self.generator_response, tmp_response)
 
+        elif signal_type == "exponential swept sine":
+            responses = SignalGenerator.deconvolveSweep(
+                [self.average_microphone_response,
+                 self.average_generator_response], self.plan)
+            (self.microphone_response, self.generator_response) = responses
+
         else:
             self.microphone_response = self.average_microphone_response
             self.generator_response = self.average_generator_response
+
     def _extractSignals(self):
         """ Extract the microphone and generator signals from the raw signals.
 
@@ -172,12 +174,10 @@ class AbsorptionCoefficient(object):
         """
         self.logger.debug("Entering _extractSignals")
 
-        sample_rate = float(self.measurement_settings["sample rate"])
-        signal_type = str(self.measurement_settings["signal type"])
+        signal_type = self.plan.signal_type
         impulse_location = int(self.measurement_settings["microphone impulse location"])
-        impulse_signal_delay = float(self.measurement_settings["impulse delay"])
 
-        impulse_signal_samples = impulse_signal_delay * sample_rate
+        impulse_signal_samples = self.plan.impulse_delay_samples
 
         signal_start = impulse_location + impulse_signal_samples
 
@@ -199,9 +199,9 @@ class AbsorptionCoefficient(object):
 
         self.average_generator_response = average(self.generator_responses,axis=0)
 
-        if signal_type.lower() == "maximum length sequence":
-            mls_reps = int(self.measurement_settings["mls reps"])
-            mls_taps = int(self.measurement_settings["mls taps"])
+        if signal_type == "maximum length sequence":
+            mls_reps = self.plan.mls_reps
+            mls_taps = self.plan.mls_taps
             assert(mls_reps > 0)
 
             mls_length = 2 ** mls_taps - 1
@@ -213,9 +213,9 @@ class AbsorptionCoefficient(object):
             mls_array = reshape(mls_sig, (mls_reps - 1, -1))
             self.average_generator_response = average(mls_array, axis=0)
 
-        elif signal_type.lower() == "inverse repeat sequence":
-            mls_reps = int(self.measurement_settings["mls reps"])
-            mls_taps = int(self.measurement_settings["mls taps"])
+        elif signal_type == "inverse repeat sequence":
+            mls_reps = self.plan.mls_reps
+            mls_taps = self.plan.mls_taps
             assert(mls_reps > 1)
 
             mls_length = 2 ** mls_taps - 1
@@ -240,7 +240,7 @@ class AbsorptionCoefficient(object):
         self.logger.debug("Entering _downsampleSignals")
 
         # Get required variables
-        sample_rate = float(self.measurement_settings["sample rate"])
+        sample_rate = self.plan.sample_rate
         decimation_factor = int(self.analysis_settings["decimation factor"])
         filter_order = int(self.analysis_settings["antialiasing filter order"])
 
@@ -268,15 +268,15 @@ class AbsorptionCoefficient(object):
         window_start = float(self.analysis_settings["window start"])
         window_end = float(self.analysis_settings["window end"])
         taper_length = float(self.analysis_settings["taper length"])
-        sample_rate = float(self.measurement_settings["sample rate"])
+        sample_rate = self.plan.sample_rate
         decimation_factor = float(self.analysis_settings["decimation factor"])
 
         effective_sample_rate = sample_rate / decimation_factor
 
         window_length = window_end - window_start
 
-        window_samples = window_length * effective_sample_rate
-        taper_samples = taper_length * effective_sample_rate
+        window_samples = int(window_length * effective_sample_rate)
+        taper_samples = int(taper_length * effective_sample_rate)
 
         # Create the window
         tapers = hanning(2 * taper_samples)
@@ -288,7 +288,7 @@ class AbsorptionCoefficient(object):
                         tapers[taper_samples:]]
         self.window[-1] = 0
         # Lift impulse response
-        start = window_start * effective_sample_rate
+        start = int(window_start * effective_sample_rate)
         end = start + len(self.window)
 
         self.impulse_response = self.power_cepstrum[start:end].copy()
@@ -322,7 +322,7 @@ class AbsorptionCoefficient(object):
         # required variables
         fft_size = int(self.measurement_settings["fft size"])
         window_start = float(self.analysis_settings["window start"])
-        sample_rate = float(self.measurement_settings["sample rate"])
+        sample_rate = self.plan.sample_rate
         decimation_factor = float(self.analysis_settings["decimation factor"])
 
         effective_sample_rate = sample_rate / decimation_factor
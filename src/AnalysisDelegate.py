@@ -1008,3 +1008,4 @@ if __name__ == "__main__":
     analysis = AnalysisDelegate()
     analysis.misidentificationAnalysis()
     #analysis.synchronizeAnalysis()
+    analysis.close()
@@ -11,6 +11,8 @@ from numpy import *
 from ctypes import *
 from ctypes.util import *
 import logging
+import threading
+import weakref
 
 __author__ = "Lance Jenkin"
 __email__ = "lancejenkin@gmail.com"
@@ -58,7 +60,9 @@ class _PaStreamCallbackTimeInfo(Structure):
 
 class AudioDevice(object):
 
-    def __init__(self, name, index, input_channels, output_channels):
+    def __init__(self, name, index, input_channels, output_channels,
+                 default_sample_rate=None, input_latency=(None, None),
+                 output_latency=(None, None), sample_rates=()):
         """ Constructor for Audio Device class
 
         :param name:
@@ -81,94 +85,633 @@ class AudioDevice(object):
             The name of the audio device.
         :type name:
             str
+        :param default_sample_rate:
+            The default sample rate of the device.
+        :type default_sample_rate:
+            float
+        :param input_latency:
+            The default low and high input latency of the device, in s.
+        :type input_latency:
+            tuple
+        :param output_latency:
+            The default low and high output latency of the device, in s.
+        :type output_latency:
+            tuple
+        :param sample_rates:
+            The standard sample rates supported by the device.
+        :type sample_rates:
+            tuple of float
         """
         self.name = name
         self.index = index
         self.input_channels = input_channels
         self.output_channels = output_channels
+        self.default_sample_rate = default_sample_rate
+        (self.low_input_latency, self.high_input_latency) = input_latency
+        (self.low_output_latency, self.high_output_latency) = output_latency
+        self.sample_rates = sample_rates
+
+
+class AudioDeviceRegistry(object):
+    # The sample rates probed for each device
+    _STANDARD_SAMPLE_RATES = (8000.0, 11025.0, 16000.0, 22050.0, 32000.0,
+                              44100.0, 48000.0, 88200.0, 96000.0, 192000.0)
+    # PortAudio return code of a supported format
+    _PA_FORMAT_IS_SUPPORTED = 0
+
+    def __init__(self, port_audio):
+        """ Constructor for AudioDeviceRegistry object, which enumerates the
+            audio devices and their capabilities once, and keeps them until
+            it is refreshed.
+
+        :param port_audio:
+            The PortAudio library, or a backend providing its API.
+        :type port_audio:
+            CDLL
+        """
+        self.logger = logging.getLogger("Alpha")
+        self.logger.debug("Creating AudioDeviceRegistry Object")
+
+        self.port_audio = port_audio
+        self.devices = None
+        self._lock = threading.RLock()
+
+        # The open sessions, which keep PortAudio initialized
+        self.sessions = weakref.WeakSet()
+
+    def getDevices(self):
+        """ Returns the audio devices, enumerating them if they have not
+            been enumerated.
+
+        :returns:
+            array : An array of AudioDevice objects, containing the audio
+            devices available on in the system.
+        """
+        with self._lock:
+            if self.devices is None:
+                self.refresh()
+
+            return list(self.devices)
+
+    def getDevice(self, device_index):
+        """ Returns the audio device with the index.
+
+        :param device_index:
+            The index of the audio device, as referenced by PortAudio.
+        :type device_index:
+            int
+
+        :returns:
+            AudioDevice : The audio device.
+        """
+        devices = self.getDevices()
+
+        if device_index is None or not 0 <= device_index < len(devices):
+            raise Exception("Unknown audio device: %s" % (device_index))
+
+        return devices[device_index]
+
+    def addSession(self, session):
+        """ Registers an open session, which is closed while the devices are
+            refreshed.
+
+        :param session:
+            The open session.
+        :type session:
+            AudioIO
+        """
+        with self._lock:
+            self.sessions.add(session)
+
+    def removeSession(self, session):
+        """ Unregisters a session, once it is closed.
+
+        :param session:
+            The closed session.
+        :type session:
+            AudioIO
+        """
+        with self._lock:
+            self.sessions.discard(session)
+
+    def refresh(self):
+        """ Enumerates the audio devices present, and probes the sample rates
+            they support.  Call when devices are added or removed.
+
+        PortAudio only scans for devices when it is first initialized, so the
+        open sessions are closed while the devices are enumerated, and then
+        opened again.  Raises an Exception if a session is playing or
+        capturing.
+        """
+        self.logger.debug("Entering refresh")
+
+        with self._lock:
+            sessions = list(self.sessions)
+            for session in sessions:
+                if session.isBusy():
+                    raise Exception("Can not refresh the audio devices while "
+                                    "a session is playing or capturing")
+
+            for session in sessions:
+                session.close()
+
+            try:
+                self._enumerateDevices()
+            finally:
+                for session in sessions:
+                    session.open()
+
+    def _enumerateDevices(self):
+        """ Initializes PortAudio, so that it scans for the devices, and
+            probes each device.
+        """
+        self.logger.debug("Entering _enumerateDevices")
+
+        with self._lock:
+            error = self.port_audio.Pa_Initialize()
+            if error != 0:
+                error_text = self.port_audio.Pa_GetErrorText(error)
+                raise Exception("Error initializing Port Audio: %s" %
+                                (error_text))
+
+            try:
+                devices = []
+                device_count = self.port_audio.Pa_GetDeviceCount()
+                for device_index in range(device_count):
+                    devices.append(self._probeDevice(device_index))
+            finally:
+                self.port_audio.Pa_Terminate()
+
+            self.devices = devices
+
+    def _probeDevice(self, device_index):
+        """ Queries PortAudio for the device info with the device index, and
+            the standard sample rates it supports.
+
+        :param device_index:
+            The index of the audio device.
+        :type device_index:
+            int
+
+        :returns:
+            AudioDevice : The audio device.
+        """
+        device_info = self.port_audio.Pa_GetDeviceInfo(device_index).contents
+
+        input_channels = device_info.maxInputChannels
+        output_channels = device_info.maxOutputChannels
+
+        input_paramaters = None
+        if input_channels > 0:
+            input_paramaters = _PaStreamParameters()
+            input_paramaters.device = device_index
+            input_paramaters.channelCount = min(input_channels, 2)
+            input_paramaters.sampleFormat = c_ulong(1)
+            input_paramaters.suggestedLatency = \
+                device_info.defaultHighInputLatency
+            input_paramaters = pointer(input_paramaters)
+
+        output_paramaters = None
+        if output_channels > 0:
+            output_paramaters = _PaStreamParameters()
+            output_paramaters.device = device_index
+            output_paramaters.channelCount = min(output_channels, 2)
+            output_paramaters.sampleFormat = c_ulong(1)
+            output_paramaters.suggestedLatency = \
+                device_info.defaultHighOutputLatency
+            output_paramaters = pointer(output_paramaters)
+
+        sample_rates = []
+        for sample_rate in self._STANDARD_SAMPLE_RATES:
+            error = self.port_audio.Pa_IsFormatSupported(input_paramaters,
+                                                         output_paramaters,
+                                                         sample_rate)
+            if error == self._PA_FORMAT_IS_SUPPORTED:
+                sample_rates.append(sample_rate)
+
+        return AudioDevice(device_info.name, device_index, input_channels,
+                           output_channels, device_info.defaultSampleRate,
+                           (device_info.defaultLowInputLatency,
+                            device_info.defaultHighInputLatency),
+                           (device_info.defaultLowOutputLatency,
+                            device_info.defaultHighOutputLatency),
+                           tuple(sample_rates))
+
+
+class RingBuffer(object):
+
+    def __init__(self, capacity, channels=2):
+        """ Constructor for a single producer, single consumer ring buffer of
+            audio frames.
+
+        The producer, the PortAudio callback, only advances the write index,
+        and the consumer only advances the read index, so neither needs a
+        lock.  If the consumer falls behind and the buffer is full, the
+        frames that do not fit are dropped, and counted as an overrun.
+
+        :param capacity:
+            The number of frames the buffer holds.
+        :type capacity:
+            int
+        :param channels:
+            The number of channels in each frame.
+        :type channels:
+            int
+        """
+        self.capacity = capacity
+        self.channels = channels
+
+        self.buffer = zeros((capacity, channels), dtype=float32)
+
+        # The total number of frames written and read, the positions in the
+        # buffer are these modulo the capacity
+        self.write_index = 0
+        self.read_index = 0
+
+        self.overruns = 0
+        self.dropped_frames = 0
+
+    def getAvailable(self):
+        """ Returns the number of frames available to read. """
+        return self.write_index - self.read_index
+
+    def write(self, frames):
+        """ Writes the frames to the buffer.  Only called by the producer.
+
+        :param frames:
+            The frames to write, one row per frame.
+        :type frames:
+            array of float32
+
+        :returns:
+            int : The number of frames written.
+        """
+        free_frames = self.capacity - (self.write_index - self.read_index)
+        frame_count = min(len(frames), free_frames)
+
+        if frame_count < len(frames):
+            self.overruns += 1
+            self.dropped_frames += len(frames) - frame_count
+
+        start = self.write_index % self.capacity
+        first_part = min(frame_count, self.capacity - start)
+        self.buffer[start:start + first_part] = frames[:first_part]
+        self.buffer[:frame_count - first_part] = frames[first_part:frame_count]
+
+        # Publish the frames only once they are written
+        self.write_index += frame_count
+
+        return frame_count
+
+    def read(self, max_frames=None):
+        """ Reads the available frames from the buffer.  Only called by the
+            consumer.
+
+        :param max_frames:
+            The maximum number of frames to read.  If None, all the available
+            frames are read.
+        :type max_frames:
+            int
+
+        :returns:
+            array of float32 : A copy of the frames read, one row per frame.
+        """
+        frame_count = self.write_index - self.read_index
+        if max_frames is not None:
+            frame_count = min(frame_count, max_frames)
+
+        start = self.read_index % self.capacity
+        first_part = min(frame_count, self.capacity - start)
+        frames = r_[self.buffer[start:start + first_part],
+                    self.buffer[:frame_count - first_part]]
+
+        # Release the space only once the frames are copied
+        self.read_index += frame_count
+
+        return frames
+
+
+class Playback(object):
+
+    def __init__(self):
+        """ Constructor for a Playback object, the future result of a
+            playback and record started by AudioIO.startPlaybackAndRecord.
+        """
+        self._finished = threading.Event()
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def done(self):
+        """ Returns True if the playback has completed. """
+        return self._finished.is_set()
+
+    def wait(self, timeout=None):
+        """ Waits for the playback to complete.
+
+        :param timeout:
+            The maximum time to wait in seconds, or None to wait until the
+            playback completes.
+        :type timeout:
+            float
+
+        :returns:
+            bool : True if the playback has completed.
+        """
+        self._finished.wait(timeout)
+
+        return self.done()
+
+    def result(self, timeout=None):
+        """ Waits for the playback to complete, and returns the recorded
+            response.
+
+        :param timeout:
+            The maximum time to wait in seconds, or None to wait until the
+            playback completes.
+        :type timeout:
+            float
+
+        :returns:
+            tuple : a two-tuple, with the left channel and right channel
+            recorded response.
+        """
+        if not self.wait(timeout):
+            raise Exception("Playback did not complete in %s s" % (timeout))
+        if self._exception is not None:
+            raise self._exception
+
+        return self._result
+
+    def addDoneCallback(self, callback):
+        """ Adds a function to call with the playback when it completes.  If
+            it has already completed, the function is called immediately.
+
+        :param callback:
+            The function to call.
+        :type callback:
+            function
+        """
+        with self._lock:
+            if not self.done():
+                self._callbacks.append(callback)
+                return
+
+        callback(self)
+
+    def _setResult(self, result):
+        """ Completes the playback with the recorded response. """
+        self._result = result
+        self._complete()
+
+    def _setException(self, exception):
+        """ Completes the playback with the error that stopped it. """
+        self._exception = exception
+        self._complete()
+
+    def _complete(self):
+        """ Marks the playback as complete, and calls the done callbacks. """
+        with self._lock:
+            self._finished.set()
+            callbacks = self._callbacks
+            self._callbacks = []
+
+        for callback in callbacks:
+            callback(self)
 
 
 class AudioIO(object):
     # Number of frames stored in the buffer
     _FRAMES_PER_BUFFER = 4096 / 4
-
-    def __init__(self, sample_rate=44100):
+    # Number of frames in the capture ring buffer, about 6 s at 44.1 kHz
+    _RING_FRAMES = 2 ** 18
+    # Interval at which the capture consumer drains the ring buffer, in s
+    _CAPTURE_INTERVAL = 0.05
+    # PortAudio status flag signalling that input data was discarded
+    _PA_INPUT_OVERFLOW = 0x2
+    # Interval at which the progress of a playback is reported, in s
+    _PROGRESS_INTERVAL = 0.1
+
+    # The device registries, keyed by backend, shared by all the sessions
+    _device_registries = {}
+    _device_registries_lock = threading.RLock()
+
+    def __init__(self, sample_rate=44100, backend=None):
         """ Default Constructor
 
+        The AudioIO object is an audio session.  PortAudio is initialized, and
+        the stream is opened on first use, then kept open between measurements
+        until the session is closed.
+
         :param sample_rate:
             The sample rate to use for playback and capture. Defaults to 
             44.1 kHz.
         :type sample_rate:
             An int or float, gets converted to float.
+        :param backend:
+            The backend providing the PortAudio API, used instead of the
+            PortAudio library, such as SimulatedPortAudio to run without a
+            sound card.  If None, the PortAudio library is loaded.
+        :type backend:
+            object
         """
         self.logger = logging.getLogger("Alpha")
         self.logger.debug("Creating AudioIO Object")
 
         self.sample_rate = float(sample_rate)
+        self.backend = backend
+        self.input_device = None
+        self.output_device = None
 
-        self._loadPortAudio()
+        self.port_audio = None
+        self.device_registry = None
+        self.stream = None
+        self.stream_callback = None
+
+        # The playback in progress, or last completed
+        self.playback = None
+        self.stream_finished = threading.Event()
+
+        # Continuous capture
+        self.ring_buffer = None
+        self.capture_thread = None
+
+        # The data shared with the callback, for the lifetime of the session
+        self.data = _PaData()
+
+        self.open()
 
     def __del__(self):
         """Deconstructor to terminate connection to PortAudio """
         self.logger.debug("Deleting AudioIO Object")
 
+        self.close()
+
+    def open(self):
+        """ Opens the audio session, initializing PortAudio if the session is
+            not already open.
+        """
+        if self.port_audio is None:
+            self._loadPortAudio()
+
+    def close(self):
+        """ Closes the audio session, closing the stream and terminating
+            PortAudio.  The session is opened again when it is next used.
+        """
+        if self.port_audio is None:
+            return
+
+        self.logger.debug("Entering close")
+
+        if self.capture_thread is not None:
+            self.stopCapture()
+
+        self._closeStream()
         self.port_audio.Pa_Terminate()
+        self.port_audio = None
+
+        self.device_registry.removeSession(self)
+        self.device_registry = None
+
+    def isBusy(self):
+        """ Returns True if the session is playing or capturing. """
+        if self.capture_thread is not None:
+            return True
+
+        return self.playback is not None and not self.playback.done()
+
+    def setSampleRate(self, sample_rate):
+        """ Sets the sample rate to use for playback and capture.
+
+        :param sample_rate:
+            The sample rate.
+        :type sample_rate:
+            An int or float, gets converted to float.
+        """
+        self.logger.debug("Entering setSampleRate (%s)" % (sample_rate))
+
+        if float(sample_rate) != self.sample_rate:
+            self._closeStream()
+            self.sample_rate = float(sample_rate)
 
     def _loadPortAudio(self):
         """ Load the PortAudio library
 
-        Tries to locate the PortAudio library, and load it.  If it can't be
-        found, or initialiazed, an Exception will be raised.
+        Tries to locate the PortAudio library, and load it, unless a backend
+        was given.  If it can't be found, or initialiazed, an Exception will
+        be raised.
         """
         self.logger.debug("Entering _loadPortAudio")
 
-        port_audio = find_library("portaudio")
-
-        if port_audio is None:
-            port_audio = "./PortAudio.dll"
-
-        try:
-            self.port_audio = CDLL(port_audio)
-        except Exception as inst:
-            raise Exception("Port Audio not load: %s" % (inst))
+        port_audio = self._loadLibrary(self.backend)
 
-        error = self.port_audio.Pa_Initialize()
+        error = port_audio.Pa_Initialize()
 
         if error != 0:
-            error_text = self.port_audio.Pa_GetErrorText(error)
+            error_text = port_audio.Pa_GetErrorText(error)
             raise Exception("Error initializing Port Audio: %s" % (error_text))
 
-    def getAudioDevices(self):
-        """ Method to return list of audio devices present.
+        self.port_audio = port_audio
+        self.device_registry = self.getDeviceRegistry(self.backend)
+        self.device_registry.addSession(self)
+
+    @staticmethod
+    def _loadLibrary(backend=None):
+        """ Loads the PortAudio library, and declares the types of the
+            functions that take structures.
 
-        Queries PortAudio to return a list of audio devices present in the
-        system, along with the audio device name, it also returns the number
-        of input and output devices, and its specific device index.
+        :param backend:
+            The backend providing the PortAudio API, or None to load the
+            PortAudio library.
+        :type backend:
+            object
 
         :returns:
-            array : An array of AudioDevice objects, containing the audio
-            devices available on in the system.
+            CDLL : The PortAudio library, or the backend.
         """
-        self.logger.debug("Entering getAudioDevices")
+        if backend is not None:
+            port_audio = backend
+        else:
+            library_name = find_library("portaudio")
 
-        audio_devices = []
+            if library_name is None:
+                library_name = "./PortAudio.dll"
 
-        device_count = self.port_audio.Pa_GetDeviceCount()
-        for device_index in range(device_count):
-            # Ask Port Audio for the device info with specified device_index
-            self.port_audio.Pa_GetDeviceInfo.restype = POINTER(_PaDeviceInfo)
-            pa_device_info = self.port_audio.Pa_GetDeviceInfo(device_index)
+            try:
+                port_audio = CDLL(library_name)
+            except Exception as inst:
+                raise Exception("Port Audio not load: %s" % (inst))
 
-            name = pa_device_info.contents.name
-            input_channels = pa_device_info.contents.maxInputChannels
-            output_channels = pa_device_info.contents.maxOutputChannels
+        port_audio.Pa_GetDeviceInfo.restype = POINTER(_PaDeviceInfo)
 
-            audio_device = AudioDevice(name, device_index, input_channels,
-                                       output_channels)
+        port_audio.Pa_IsFormatSupported.argtypes = [
+            POINTER(_PaStreamParameters), POINTER(_PaStreamParameters),
+            c_double]
+        port_audio.Pa_IsFormatSupported.restype = c_int
 
-            audio_devices.append(audio_device)
+        port_audio.Pa_OpenStream.argtypes = [POINTER(c_void_p),
+                                             POINTER(_PaStreamParameters),
+                                             POINTER(_PaStreamParameters),
+                                             c_double, c_long, c_long,
+                                             c_void_p, POINTER(_PaData)]
+        port_audio.Pa_OpenStream.restype = c_int
 
-        return audio_devices
+        port_audio.Pa_SetStreamFinishedCallback.argtypes = [c_void_p,
+                                                            c_void_p]
+        port_audio.Pa_SetStreamFinishedCallback.restype = c_int
+
+        return port_audio
+
+    @classmethod
+    def getDeviceRegistry(cls, backend=None):
+        """ Returns the registry of the audio devices, which is shared by all
+            the sessions using the backend.  The devices are only enumerated
+            when first requested, or when the registry is refreshed, without
+            opening a session.
+
+        :param backend:
+            The backend providing the PortAudio API, or None for the PortAudio
+            library.
+        :type backend:
+            object
+
+        :returns:
+            AudioDeviceRegistry : The registry of the audio devices.
+        """
+        with cls._device_registries_lock:
+            if backend not in cls._device_registries:
+                port_audio = cls._loadLibrary(backend)
+                cls._device_registries[backend] = \
+                    AudioDeviceRegistry(port_audio)
+
+            return cls._device_registries[backend]
+
+    def getAudioDevices(self, refresh=False):
+        """ Method to return list of audio devices present.
+
+        Returns the audio devices present in the system, along with the audio
+        device name, it also returns the number of input and output devices,
+        and its specific device index.  The devices are enumerated once, and
+        shared by all the sessions, until they are refreshed.
+
+        :param refresh:
+            If True, enumerate the devices again, such as when a device is
+            plugged in.
+        :type refresh:
+            bool
+
+        :returns:
+            array : An array of AudioDevice objects, containing the audio
+            devices available on in the system.
+        """
+        self.logger.debug("Entering getAudioDevices")
+
+        device_registry = self.getDeviceRegistry(self.backend)
+        if refresh:
+            device_registry.refresh()
+
+        return device_registry.getDevices()
 
     def setInputDevice(self, device_index):
         """ Sets the input device to capture the signals.
@@ -180,7 +723,9 @@ class AudioIO(object):
         """
         self.logger.debug("Entering setInputDevice (%s)" % (device_index))
 
-        self.input_device = device_index
+        if device_index != self.input_device:
+            self._closeStream()
+            self.input_device = device_index
 
     def setOutputDevice(self, device_index):
         """ Sets the output device to playback the signals.
@@ -192,7 +737,9 @@ class AudioIO(object):
         """
         self.logger.debug("Entering setOutputDevice (%s)" % (device_index))
 
-        self.output_device = device_index
+        if device_index != self.output_device:
+            self._closeStream()
+            self.output_device = device_index
 
     def playbackAndRecord(self, left_channel_signal, right_channel_signal):
         """ Playback the given signal and record the response.
@@ -218,49 +765,115 @@ class AudioIO(object):
         :returns:
             tuple : a two-tuple, with the first element an array containing the
             the left channel recorded response, and the second element
-            containing the right channel response.
+            containing the right channel response.  The arrays are float32,
+            and share the memory the response was captured to.
         """
         self.logger.debug("Entering playbackAndRecord")
 
-        # Open the stream
-        self._openStream(left_channel_signal, right_channel_signal)
+        playback = self.startPlaybackAndRecord(left_channel_signal,
+                                               right_channel_signal)
+
+        return playback.result()
+
+    def startPlaybackAndRecord(self, left_channel_signal, right_channel_signal,
+                               progress=None):
+        """ Starts to playback the given signal and record the response,
+            without waiting for the playback to complete.
+
+        PortAudio signals when the stream has finished, so the result is
+        available as soon as the last block is captured.  Only one playback
+        can be in progress at a time, but the result of the previous playback
+        can be analyzed while the next one plays.
+
+        :param left_channel_signal:
+            The signal to playback through the left channel.
+        :type left_channel_signal:
+            Array representing the signal, containing float values between -1
+            and +1.
+        :param right_channel_signal:
+            The signal to playback through the right channel.
+        :type right_channel_signal:
+            Array representing the signal, containing float values between -1
+            and +1.
+        :param progress:
+            Called periodically, from a separate thread, with the number of
+            samples recorded and the total number of samples to record.
+        :type progress:
+            function
+
+        :returns:
+            Playback : The playback in progress, whose result is the same
+            two-tuple as returned by playbackAndRecord.
+        """
+        self.logger.debug("Entering startPlaybackAndRecord")
+
+        # Prepare the signals, and open the stream if it is not already open
+        self.open()
+        if self.capture_thread is not None:
+            raise Exception("Can not playback while capturing")
+        if self.playback is not None and not self.playback.done():
+            raise Exception("Playback already in progress")
+
+        self._setSignals(left_channel_signal, right_channel_signal)
+        if self.stream is None or self.stream_callback is not None:
+            self._closeStream()
+            self._openStream()
 
         # Begin playback
+        self.stream_finished.clear()
         error = self.port_audio.Pa_StartStream(self.stream)
         if error < 0:
             error_text = self.port_audio.Pa_GetErrorText(error)
             raise Exception("Couldn't start stream: %s" % (error_text))
 
-        # Wait until completed playback
-        while self.port_audio.Pa_IsStreamActive(self.stream) == 1:
-            self.port_audio.Pa_Sleep(500)
+        self.playback = Playback()
 
-        # Ensure the stream has stopped
-        self.port_audio.Pa_StopStream(self.stream)
+        waiter = threading.Thread(target=self._waitForPlayback,
+                                  args=(self.playback, progress))
+        waiter.daemon = True
+        waiter.start()
 
-        # Retrieve the recorded response
-        left_channel_buffer = cast(self.data.left_channel_buffer, POINTER(c_float))
+        return self.playback
 
-        right_channel_buffer = cast(self.data.right_channel_buffer, POINTER(c_float))
+    def _waitForPlayback(self, playback, progress):
+        """ Waits until PortAudio signals the stream has finished, then
+            completes the playback with the recorded response.
 
-        # Cast to Python array
-        left_channel_data = []
-        right_channel_data = []
+        :param playback:
+            The playback in progress.
+        :type playback:
+            Playback
+        :param progress:
+            Called periodically with the number of samples recorded and the
+            total number of samples to record, or None.
+        :type progress:
+            function
+        """
+        try:
+            total_samples = len(self.left_channel_buffer)
+            while not self.stream_finished.wait(self._PROGRESS_INTERVAL):
+                if progress is not None:
+                    progress(self.data.num_samples_read, total_samples)
 
-        samples_read = self.data.num_samples_read
-        for signal_index in range(samples_read):
-            left_channel_data.append(left_channel_buffer[signal_index])
-            right_channel_data.append(right_channel_buffer[signal_index])
+            # Ensure the stream has stopped
+            self.port_audio.Pa_StopStream(self.stream)
 
-        return (left_channel_data, right_channel_data)
+            # Retrieve the recorded response, sharing the capture buffers
+            samples_read = self.data.num_samples_read
+            left_channel_data = self.left_channel_buffer[:samples_read]
+            right_channel_data = self.right_channel_buffer[:samples_read]
 
-    def _openStream(self, left_channel_signal, right_channel_signal):
-        """ Open a PortAudio stream to playback the specified signals, and
-            record the response.
+            if progress is not None:
+                progress(samples_read, total_samples)
 
-        Creates a new stream, and passes the stream information to PortAudio.
+            playback._setResult((left_channel_data, right_channel_data))
+        except Exception as error:
+            self.logger.error("Playback failed: %s" % (error))
+            playback._setException(error)
 
-        Raises an Exception if the stream could not open.
+    def _setSignals(self, left_channel_signal, right_channel_signal):
+        """ Sets the signals to playback, and reserves the memory to record
+            the response, resetting the data shared with the callback.
 
         :param left_channel_signal:
             The signal to playback through the left channel.
@@ -270,6 +883,199 @@ class AudioIO(object):
         :param right_channel_signal:
             The signal to playback through the right channel.
         """
+        self.logger.debug("Entering _setSignals")
+
+        # PortAudio plays the signals directly from their memory, which is
+        # only copied if the signals are not contiguous float32 arrays.  The
+        # memory is kept referenced while the stream is playing.
+        self.left_channel_signal_memory = ascontiguousarray(left_channel_signal,
+                                                            dtype=float32)
+        self.right_channel_signal_memory = ascontiguousarray(right_channel_signal,
+                                                             dtype=float32)
+
+        left_signal_length = len(self.left_channel_signal_memory)
+        right_signal_length = len(self.right_channel_signal_memory)
+
+        # Reserve memory to record the response
+        max_signal_length = max(left_signal_length, right_signal_length)
+        self.left_channel_buffer = zeros(max_signal_length, dtype=float32)
+        self.right_channel_buffer = zeros(max_signal_length, dtype=float32)
+
+        # Update the Data structure
+        left_signal_address = self.left_channel_signal_memory.ctypes.data
+        right_signal_address = self.right_channel_signal_memory.ctypes.data
+        left_buffer_address = self.left_channel_buffer.ctypes.data
+        right_buffer_address = self.right_channel_buffer.ctypes.data
+
+        self.data.first_run = True
+        self.data.num_samples_read = 0
+        self.data.sample_index = 0
+        self.data.left_signal_length = left_signal_length
+        self.data.right_signal_length = right_signal_length
+        self.data.left_channel_signal = left_signal_address
+        self.data.right_channel_signal = right_signal_address
+        self.data.left_channel_buffer = left_buffer_address
+        self.data.right_channel_buffer = right_buffer_address
+
+    def startCapture(self, consumer=None, output_blocks=None,
+                     ring_frames=None):
+        """ Starts capturing continuously, without a fixed length.
+
+        The PortAudio callback writes the captured frames to a ring buffer,
+        which a consumer thread drains, so the callback is never held up by
+        the processing of the frames.  If the consumer falls behind, frames
+        are dropped and reported as overruns.
+
+        :param consumer:
+            Called from the consumer thread with each array of captured frames,
+            with a column for the left and the right channel.  If None, the
+            frames are kept, and returned by stopCapture.
+        :type consumer:
+            function
+        :param output_blocks:
+            An iterator of blocks to play through the left channel.  The
+            blocks may be of any length, and are played one after the other.
+            If None, or when exhausted, silence is played.
+        :type output_blocks:
+            iterator
+        :param ring_frames:
+            The number of frames the ring buffer holds.
+        :type ring_frames:
+            int
+        """
+        self.logger.debug("Entering startCapture")
+
+        self.open()
+        if self.capture_thread is not None:
+            raise Exception("Already capturing")
+
+        if ring_frames is None:
+            ring_frames = self._RING_FRAMES
+
+        self.ring_buffer = RingBuffer(ring_frames)
+        self.output_blocks = output_blocks
+        self.output_block = None
+        self.captured_frames = []
+        self.capture_consumer = consumer
+        self.capture_stopped = threading.Event()
+
+        self._closeStream()
+        self._openStream(self._captureCallback)
+
+        error = self.port_audio.Pa_StartStream(self.stream)
+        if error < 0:
+            self._closeStream()
+            error_text = self.port_audio.Pa_GetErrorText(error)
+            raise Exception("Couldn't start stream: %s" % (error_text))
+
+        self.capture_thread = threading.Thread(target=self._consumeCapture)
+        self.capture_thread.daemon = True
+        self.capture_thread.start()
+
+    def stopCapture(self):
+        """ Stops capturing, and returns the captured response.
+
+        :returns:
+            tuple : a two-tuple, with the left channel and the right channel
+            captured response.  If a consumer was given to startCapture, the
+            responses are empty.
+        """
+        self.logger.debug("Entering stopCapture")
+
+        if self.capture_thread is None:
+            raise Exception("Not capturing")
+
+        self.port_audio.Pa_StopStream(self.stream)
+        self._closeStream()
+
+        # The consumer drains the remaining frames before finishing
+        self.capture_stopped.set()
+        self.capture_thread.join()
+        self.capture_thread = None
+
+        if self.ring_buffer.overruns > 0:
+            self.logger.warning("Capture overran %s times, dropping %s frames"
+                                % (self.ring_buffer.overruns,
+                                   self.ring_buffer.dropped_frames))
+
+        if self.captured_frames:
+            frames = concatenate(self.captured_frames)
+        else:
+            frames = zeros((0, 2), dtype=float32)
+        self.captured_frames = []
+
+        return (frames[:, 0], frames[:, 1])
+
+    def _consumeCapture(self):
+        """ Drains the capture ring buffer, until the capture is stopped. """
+        while True:
+            stopped = self.capture_stopped.wait(self._CAPTURE_INTERVAL)
+
+            frames = self.ring_buffer.read()
+            if len(frames) > 0:
+                if self.capture_consumer is None:
+                    self.captured_frames.append(frames)
+                else:
+                    self.capture_consumer(frames)
+
+            if stopped:
+                break
+
+    def _captureCallback(self, input_buffer, output_buffer, frames_per_buffer,
+                         time_info, status_flags, user_data):
+        """ PortAudio callback used while capturing continuously.  It writes
+            the captured frames to the ring buffer, and plays the next output
+            block.
+
+        :returns:
+            0, to continue the stream until it is stopped.
+        """
+        if status_flags & self._PA_INPUT_OVERFLOW:
+            self.ring_buffer.overruns += 1
+
+        frames = self._floatView(input_buffer, 2 * frames_per_buffer)
+        self.ring_buffer.write(frames.reshape(frames_per_buffer, 2))
+
+        output = self._floatView(output_buffer, 2 * frames_per_buffer)
+        output = output.reshape(frames_per_buffer, 2)
+        output[:] = 0
+
+        # Fill the buffer from the output blocks, keeping the part of a block
+        # that does not fit for the next buffer
+        frames_played = 0
+        while frames_played < frames_per_buffer and \
+                self.output_blocks is not None:
+            if self.output_block is None or len(self.output_block) == 0:
+                self.output_block = next(self.output_blocks, None)
+                if self.output_block is None:
+                    self.output_blocks = None
+                    break
+
+            play_length = min(len(self.output_block),
+                              frames_per_buffer - frames_played)
+            output[frames_played:frames_played + play_length, 0] = \
+                self.output_block[:play_length]
+            self.output_block = self.output_block[play_length:]
+            frames_played += play_length
+
+        return 0
+
+    def _openStream(self, callback=None):
+        """ Open a PortAudio stream to playback the signals, and record the
+            response.
+
+        Creates a new stream, and passes the stream information to PortAudio.
+        The stream stays open, and is restarted for each playback, until the
+        devices or sample rate change or the session is closed.
+
+        Raises an Exception if the stream could not open.
+
+        :param callback:
+            The callback to use instead of pa_callback, such as the capture
+            callback.
+        :type callback:
+            function
+        """
         self.logger.debug("Entering _openStream")
 
         # Set the input / output paramaters
@@ -277,77 +1083,41 @@ class AudioIO(object):
         output_paramaters = _PaStreamParameters()
 
         # Set input device
-        self.port_audio.Pa_GetDeviceInfo.restype = POINTER(_PaDeviceInfo)
-        device_info = self.port_audio.Pa_GetDeviceInfo(self.input_device)
+        input_device = self.device_registry.getDevice(self.input_device)
         input_paramaters.device = self.input_device
         input_paramaters.channelCount = 2
         input_paramaters.sampleFormat = c_ulong(1)
-        latency = device_info.contents.defaultHighInputLatency
-        input_paramaters.suggestedLatency = latency
+        input_paramaters.suggestedLatency = input_device.high_input_latency
         input_paramaters.hostApiSpecificStreamInfo = c_void_p()
 
         # Set output device
-        self.port_audio.Pa_GetDeviceInfo.restype = POINTER(_PaDeviceInfo)
-        device_info = self.port_audio.Pa_GetDeviceInfo(self.output_device)
+        output_device = self.device_registry.getDevice(self.output_device)
         output_paramaters.device = self.output_device
         output_paramaters.channelCount = 2
         output_paramaters.sampleFormat = c_ulong(1)
-        latency = device_info.contents.defaultHighOutputLatency
-        output_paramaters.suggestedLatency = latency
+        output_paramaters.suggestedLatency = output_device.high_output_latency
         output_paramaters.hostApiSpecificStreamInfo = c_void_p()
 
-        # Reserve space for the signal
-        left_signal_length = len(left_channel_signal)
-        right_signal_length = len(right_channel_signal)
-
-        self.left_channel_signal_memory = (c_float * left_signal_length)()
-        self.right_channel_signal_memory = (c_float * right_signal_length)()
-
-        # Copy the signal data to the memory
-        for signal_index in range(left_signal_length):
-            self.left_channel_signal_memory[signal_index] = (left_channel_signal[signal_index])
-
-        for signal_index in range(right_signal_length):
-            self.right_channel_signal_memory[signal_index] = (right_channel_signal[signal_index])
-
-        # Reserve memory to record the response
-        max_signal_length = max(left_signal_length, right_signal_length)
-        self.left_channel_buffer = (c_float * max_signal_length)()
-        self.right_channel_buffer = (c_float * max_signal_length)()
-
-        # Create the Data structure
-        left_signal_address = addressof(self.left_channel_signal_memory)
-        right_signal_address = addressof(self.right_channel_signal_memory)
-        left_buffer_address = addressof(self.left_channel_buffer)
-        right_buffer_address = addressof(self.right_channel_buffer)
-
-        self.data = _PaData()
-        self.data.first_run = True
-        self.data.num_samples_read = 0
-        self.data.sample_index = 0
-        self.data.left_signal_length = left_signal_length
-        self.data.right_signal_length = right_signal_length
-        self.data.left_channel_signal = left_signal_address
-        self.data.right_channel_signal = right_signal_address
-        self.data.left_channel_buffer = left_buffer_address
-        self.data.right_channel_buffer = right_buffer_address
-
         # Open the stream
         PACALLBACK = CFUNCTYPE(c_int, c_void_p, c_void_p, c_ulong,
                              POINTER(_PaStreamCallbackTimeInfo),
                              c_ulong, c_void_p)
 
-        self.pa_callback_cfunc = PACALLBACK(self.pa_callback)
+        if callback is None:
+            self.pa_callback_cfunc = PACALLBACK(self.pa_callback)
+        else:
+            self.pa_callback_cfunc = PACALLBACK(callback)
+
+        # The finished callback only references the event, so the session
+        # does not reference itself, and is deleted when it is released
+        stream_finished = self.stream_finished
+        PAFINISHEDCALLBACK = CFUNCTYPE(None, c_void_p)
+        self.pa_finished_cfunc = PAFINISHEDCALLBACK(
+            lambda user_data: stream_finished.set())
 
-        self.stream = c_void_p()
+        stream = c_void_p()
         pa_openstream = self.port_audio.Pa_OpenStream
-        pa_openstream.argtypes = [POINTER(c_void_p),
-                                  POINTER(_PaStreamParameters),
-                                  POINTER(_PaStreamParameters), c_double,
-                                  c_long, c_long, c_void_p, POINTER(_PaData)]
-
-        pa_openstream.restype = c_int
-        error = pa_openstream(pointer(self.stream), pointer(input_paramaters),
+        error = pa_openstream(pointer(stream), pointer(input_paramaters),
                       pointer(output_paramaters), self.sample_rate,
                       self._FRAMES_PER_BUFFER, 1, self.pa_callback_cfunc,
                       pointer(self.data))
@@ -356,6 +1126,32 @@ class AudioIO(object):
             error_text = self.port_audio.Pa_GetErrorText(error)
             raise Exception("Couldn't open stream: %s" % (error_text))
 
+        self.stream = stream
+        self.stream_callback = callback
+
+        # Signal the end of the playback as soon as the stream finishes
+        pa_setfinished = self.port_audio.Pa_SetStreamFinishedCallback
+        error = pa_setfinished(self.stream, cast(self.pa_finished_cfunc,
+                                                 c_void_p))
+        if error < 0:
+            error_text = self.port_audio.Pa_GetErrorText(error)
+            raise Exception("Couldn't set stream callback: %s" % (error_text))
+
+    def _closeStream(self):
+        """ Closes the PortAudio stream, if it is open. """
+        if self.stream is None:
+            return
+
+        self.logger.debug("Entering _closeStream")
+
+        self.port_audio.Pa_CloseStream(self.stream)
+        self.stream = None
+        self.stream_callback = None
+
+        # Release the callbacks, the capture callback references the session
+        self.pa_callback_cfunc = None
+        self.pa_finished_cfunc = None
+
     @staticmethod
     def pa_callback(input_buffer, output_buffer, frames_per_buffer, time_info,
                   status_flags, user_data):
@@ -398,80 +1194,83 @@ class AudioIO(object):
             Status indicating if Port Audio needs to continue with the stream
             0 means continue, and 1 means stop.
         """
-        # Cast variables so that they can be used
-        data = cast(user_data, POINTER(_PaData))
-        out_ptr = cast(output_buffer, POINTER(c_float))
-        in_ptr = cast(input_buffer, POINTER(c_float))
+        data = cast(user_data, POINTER(_PaData)).contents
 
         # Determine the maximum signal length, as left channel's signal may be
         # different to the right channel.
-        left_signal_length = data.contents.left_signal_length
-        right_signal_length = data.contents.right_signal_length
-        max_length = max([left_signal_length, right_signal_length])
+        max_length = max(data.left_signal_length, data.right_signal_length)
 
         # Determine how many samples to read from the microphone, bearing in
         # mind that we only want as many samples as the longest signal
         # provided.
-        samples_read = data.contents.num_samples_read
-        read_length = min([max_length - samples_read, frames_per_buffer])
-        
-        # Cast the pointers into usable c_float pointers
-        left_chan_buf = data.contents.left_channel_buffer
-        right_chan_buf = data.contents.right_channel_buffer
-        
-        left_channel_buffer = cast(left_chan_buf, POINTER(c_float))
-        right_channel_buffer = cast(right_chan_buf, POINTER(c_float))
-
-        if data.contents.first_run:
+        samples_read = data.num_samples_read
+        read_length = min(max_length - samples_read, frames_per_buffer)
+
+        if data.first_run:
             # Ignore the first run's buffer
-            data.contents.first_run = False
-        else:
+            data.first_run = False
+        elif read_length > 0:
             # Read the information from the microphone, keeping in mind that
             # the data is interleaved, with the first c_float the left
             # channel, the next c_float the right channel, and alternating
             # from there.
-            for i in range(read_length):
-                index = 2 * i
-                samples_read = data.contents.num_samples_read
-
-                buf_index = i + samples_read
-                left_channel_buffer[buf_index] = c_float(in_ptr[index])
-                right_channel_buffer[buf_index] = c_float(in_ptr[index + 1])
-
-        data.contents.num_samples_read += read_length
-
-        # Play Signal
-        left_chan_ptr = data.contents.left_channel_signal
-        right_chan_ptr = data.contents.right_channel_signal
-        
-        left_channel_signal = cast(left_chan_ptr, POINTER(c_float))
-        right_channel_signal = cast(right_chan_ptr, POINTER(c_float))
-
-        for i in range(frames_per_buffer):
-            # The output pointer is interleaved
-            index = 2 * i
-            sample_index = data.contents.sample_index
-            # Left Channel
-            left_signal_length = data.contents.left_signal_length
-            if (i + data.contents.sample_index < left_signal_length):
-                out_ptr[index] = c_float(left_channel_signal[i + sample_index])
-            else:
-                out_ptr[index] = c_float(0)
-
-            # Then Right
-            right_signal_length = data.contents.right_signal_length
-            if (i + data.contents.sample_index < right_signal_length):
-                out_ptr[index + 1] = c_float(right_channel_signal[i + sample_index ])
-            else:
-                out_ptr[index + 1] = c_float(0)
+            frames = AudioIO._floatView(input_buffer, 2 * read_length)
+            frames = frames.reshape(read_length, 2)
+
+            offset = samples_read * sizeof(c_float)
+            left_channel_buffer = AudioIO._floatView(
+                data.left_channel_buffer + offset, read_length)
+            right_channel_buffer = AudioIO._floatView(
+                data.right_channel_buffer + offset, read_length)
+
+            left_channel_buffer[:] = frames[:, 0]
+            right_channel_buffer[:] = frames[:, 1]
+
+        data.num_samples_read += read_length
+
+        # Play Signal, the output buffer is interleaved
+        output = AudioIO._floatView(output_buffer, 2 * frames_per_buffer)
+        output = output.reshape(frames_per_buffer, 2)
+        output[:] = 0
+
+        sample_index = data.sample_index
+        offset = sample_index * sizeof(c_float)
+        channels = [(data.left_channel_signal, data.left_signal_length),
+                    (data.right_channel_signal, data.right_signal_length)]
+        for channel, (signal_address, signal_length) in enumerate(channels):
+            play_length = min(signal_length - sample_index, frames_per_buffer)
+            if play_length > 0:
+                signal = AudioIO._floatView(signal_address + offset,
+                                            play_length)
+                output[:play_length, channel] = signal
 
         # Only update the sample index, if it is less than the maximum signal
         # length, else we don't care as there is no more signal left
-        if data.contents.sample_index < max_length:
-            data.contents.sample_index += frames_per_buffer
+        if data.sample_index < max_length:
+            data.sample_index += frames_per_buffer
 
         # Return 0, to continue, if we still need to read more samples
-        return int(data.contents.num_samples_read >= max_length)
+        return int(data.num_samples_read >= max_length)
+
+    @staticmethod
+    def _floatView(address, length):
+        """ Returns a NumPy view of the single precision samples at the
+            address, without copying them.
+
+        :param address:
+            The address of the first sample.
+        :type address:
+            int
+        :param length:
+            The number of samples.
+        :type length:
+            int
+
+        :returns:
+            array of float32 : The view of the samples.
+        """
+        return frombuffer((c_float * length).from_address(address),
+                          dtype=float32)
 
 
 if __name__ == "__main__":
@@ -497,6 +1296,9 @@ if __name__ == "__main__":
         print "%s: %s" % (device_index, device_name)
         print "Input Channels: %s" % (input_channels)
         print "Output Channels: %s" % (output_channels)
+        print "Sample Rates: %s" % (", ".join("%g" % (sample_rate) for
+                                              sample_rate in
+                                              audio_device.sample_rates))
 
         if input_channels > 0:
             audio.setInputDevice(device_index)
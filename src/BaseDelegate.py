@@ -17,6 +17,7 @@ from FrequencyResponse import FrequencyResponse
 from Measurement import Measurement
 from MlsDb import MlsDb
 from MeasurementDb import MeasurementDb
+from SignalCache import SignalCache
 from SignalGenerator import SignalGenerator
 
 __author__ = "Lance Jenkin"
@@ -31,6 +32,9 @@ class BaseDelegate(object):
 
         # Load Singular Objects
         self.config_db = ConfigDb()
+        # Consecutive measurements usually use the same signal
+        self.signal_cache = SignalCache()
+        self.audio = None
 
         # Load the Config
         self._loadConfig()
@@ -85,7 +89,13 @@ class BaseDelegate(object):
         if measurement_settings is None:
             measurement_settings = self.measurement_settings
 
-        measurement = Measurement(measurement_settings)
+        # The audio session is opened for the first measurement, and kept open
+        # for the following measurements
+        if self.audio is None:
+            self.audio = AudioIO(measurement_settings["sample rate"])
+
+        measurement = Measurement(measurement_settings, self.signal_cache,
+                                  self.audio)
 
         measurement.startMeasurement()
 
@@ -190,8 +200,27 @@ class BaseDelegate(object):
         """ Gets the available audio devices on the system """
         self.logger.debug("Entering _getAudioDevices")
 
-        audio = AudioIO()
-        self.audio_devices = audio.getAudioDevices()
+        # The devices are enumerated once, without opening an audio session
+        self.audio_devices = AudioIO.getDeviceRegistry().getDevices()
+
+    def refreshAudioDevices(self):
+        """ Enumerates the audio devices again, such as when a device is
+            plugged in.
+        """
+        self.logger.debug("Entering refreshAudioDevices")
+
+        AudioIO.getDeviceRegistry().refresh()
+        self._getAudioDevices()
+
+    def close(self):
+        """ Closes the audio session, if one was opened.  Call when shutting
+            down, rather than relying on the session being garbage collected.
+        """
+        self.logger.debug("Entering close")
+
+        if self.audio is not None:
+            self.audio.close()
+            self.audio = None
 
 if __name__ == "__main__":
     """ A simple example showing the use of the BaseDelegate """
@@ -217,4 +246,6 @@ if __name__ == "__main__":
     py.plot(alpha.generator_response)
     py.show()
 
+    delegate.close()
+
 
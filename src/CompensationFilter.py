@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+""" Provides loudspeaker compensation filters, used to flatten the spectrum of
+    the excitation signal as played by the loudspeaker.
+
+The compensation filter is built from a frequency response measurement of the
+loudspeaker.  The logarithm of the squared magnitude of the frequency response
+is smoothed at low frequencies by fitting a cosine series, and the magnitude
+of the compensation filter is given by
+    |Sf| = |St| / |Sl|
+with:
+    Sf the frequency response of the compensation filter
+    St the target spectrum, which is flat
+    Sl the loudspeaker response
+
+The compensation filter is made minimum phase, so that it is causal and as
+short as possible in the time domain.  Building the filter is slow, so the
+resulting impulse response is saved, keyed by the contents of the measurement,
+and reused by later signals.
+"""
+
+import hashlib
+import logging
+import os
+import sys
+import threading
+
+from numpy import arange, cos, dot, exp, pi, log, log10, linspace, ceil, r_, \
+    maximum, zeros, load, save
+from numpy.fft import rfft, irfft
+from numpy.linalg import pinv
+from scipy.signal import fftconvolve
+
+from FrequencyResponse import FrequencyResponse
+from MeasurementDb import MeasurementDb
+
+__author__ = "Lance Jenkin"
+__email__ = "lancejenkin@gmail.com"
+
+
+class CompensationFilter(object):
+    if getattr(sys, 'frozen', None):
+        basedir = sys._MEIPASS
+    else:
+        basedir = os.path.dirname(__file__)
+    _FILTER_DIRECTORY = os.path.join(basedir, "compensation")
+    # The number of cosines fitted to the low frequency response
+    _FIT_ORDER = 20
+    # The frequency up to which the response is fitted
+    _FIT_FREQUENCY = 4410.0
+    # The fraction of the fitted response blended into the measured response
+    _BLEND_FRACTION = 0.1
+    # The maximum boost of the compensation filter, in dB, which limits the
+    # boost where the loudspeaker barely responds
+    _MAX_BOOST = 40.0
+
+    # Filters already loaded in this process, keyed by filter key
+    _filters = {}
+    _filters_lock = threading.RLock()
+
+    def __init__(self, filter_directory=None):
+        """ Constructor for CompensationFilter object.
+
+        :param filter_directory:
+            The directory to save the compensation filters to.  If None, the
+            default directory is used.
+        :type filter_directory:
+            str
+        """
+        self.logger = logging.getLogger("Alpha")
+        self.logger.debug("Creating CompensationFilter Object")
+
+        if filter_directory is None:
+            filter_directory = self._FILTER_DIRECTORY
+        self.filter_directory = filter_directory
+
+    def getFilter(self, measurement_filename):
+        """ Returns the impulse response of the compensation filter for the
+            loudspeaker measurement, building it if it has not been built.
+
+        :param measurement_filename:
+            The filename of the loudspeaker frequency response measurement.
+        :type measurement_filename:
+            str
+
+        :returns:
+            array of float : The impulse response of the filter, which is
+            shared and therefore read only.
+        """
+        self.logger.debug("Entering getFilter")
+
+        filter_key = self.filterKey(measurement_filename)
+
+        with self._filters_lock:
+            if filter_key in self._filters:
+                return self._filters[filter_key]
+
+            filter_filename = self._filterFilename(filter_key)
+            if os.path.exists(filter_filename):
+                self.logger.debug("Loading compensation filter %s" %
+                                  (filter_key))
+                impulse_response = load(filter_filename)
+            else:
+                impulse_response = self.buildFilter(measurement_filename)
+
+            impulse_response.flags.writeable = False
+            self._filters[filter_key] = impulse_response
+
+        return impulse_response
+
+    def buildFilter(self, measurement_filename):
+        """ Builds the compensation filter for the loudspeaker measurement, and
+            saves it to the filter directory.
+
+        :param measurement_filename:
+            The filename of the loudspeaker frequency response measurement.
+        :type measurement_filename:
+            str
+
+        :returns:
+            array of float : The impulse response of the filter.
+        """
+        self.logger.debug("Entering buildFilter")
+
+        filter_key = self.filterKey(measurement_filename)
+
+        freq_response = self._loadFrequencyResponse(measurement_filename)
+        sample_rate = float(freq_response.measurement_settings["sample rate"])
+
+        log_magnitude = self._smoothResponse(freq_response.frequency_response,
+                                             sample_rate)
+        impulse_response = self._minimumPhaseFilter(log_magnitude)
+
+        if not os.path.exists(self.filter_directory):
+            os.makedirs(self.filter_directory)
+        save(self._filterFilename(filter_key), impulse_response)
+
+        return impulse_response
+
+    def filterKey(self, measurement_filename):
+        """ Determines the key of the compensation filter, from the contents of
+            the loudspeaker measurement.
+
+        :param measurement_filename:
+            The filename of the loudspeaker frequency response measurement.
+        :type measurement_filename:
+            str
+
+        :returns:
+            str : A hex digest identifying the measurement.
+        """
+        if not os.path.exists(measurement_filename):
+            raise Exception("Loudspeaker measurement %s does not exist" %
+                            (measurement_filename))
+
+        digest = hashlib.sha1()
+        with open(measurement_filename, "rb") as measurement_file:
+            for chunk in iter(lambda: measurement_file.read(2 ** 20), ""):
+                digest.update(chunk)
+
+        return digest.hexdigest()
+
+    @staticmethod
+    def applyFilter(signal, impulse_response):
+        """ Filters the signal with the compensation filter, by FFT
+            convolution.
+
+        :param signal:
+            The signal to filter.
+        :type signal:
+            array of float
+        :param impulse_response:
+            The impulse response of the compensation filter.
+        :type impulse_response:
+            array of float
+
+        :returns:
+            array of float : The filtered signal, the same length as the
+            signal.
+        """
+        return fftconvolve(signal, impulse_response)[:len(signal)]
+
+    def _filterFilename(self, filter_key):
+        """ Returns the filename the filter with the key is saved to. """
+        return os.path.join(self.filter_directory, "%s.npy" % (filter_key))
+
+    def _loadFrequencyResponse(self, measurement_filename):
+        """ Loads and analyzes the loudspeaker frequency response measurement.
+
+        :param measurement_filename:
+            The filename of the loudspeaker frequency response measurement.
+        :type measurement_filename:
+            str
+
+        :returns:
+            FrequencyResponse : The analyzed measurement.
+        """
+        self.logger.debug("Entering _loadFrequencyResponse")
+
+        measurement_db = MeasurementDb(measurement_filename)
+
+        signals = measurement_db.getSignals()
+        measurement_settings = measurement_db.getMeasurementSettings()
+
+        return FrequencyResponse(signals["microphone"], signals["generator"],
+                                 measurement_settings)
+
+    def _smoothResponse(self, frequency_response, sample_rate):
+        """ Smooths the logarithm of the squared magnitude of the frequency
+            response, up to the fit frequency.
+
+            We are solving A w = 2 * log10(abs(y)), with the rows of A cosines
+            of increasing frequency.  The fitted response is blended into the
+            measured response over the last part of the fit.
+
+        :param frequency_response:
+            The frequency response of the loudspeaker, with fft size points.
+        :type frequency_response:
+            array of complex
+        :param sample_rate:
+            The sample rate of the measurement.
+        :type sample_rate:
+            float
+
+        :returns:
+            array of float : 2 * log10 of the smoothed magnitude, for the
+            fft size / 2 + 1 bins of a real FFT.
+        """
+        self.logger.debug("Entering _smoothResponse")
+
+        N = len(frequency_response)
+        magnitude = abs(frequency_response[:N / 2 + 1])
+
+        # Limit the range of the response, and hence the compensation boost
+        magnitude = maximum(magnitude,
+                            magnitude.max() * 10 ** (-self._MAX_BOOST / 20))
+        log_response = 2 * log10(magnitude)
+
+        # find the bin of the fit frequency
+        fit_bins = int(self._FIT_FREQUENCY * N / sample_rate)
+        k = arange(fit_bins)
+
+        A = cos(2 * pi * arange(self._FIT_ORDER)[:, None] * k / fit_bins)
+
+        # Determine the weights
+        W = dot(pinv(A).transpose(), log_response[:fit_bins])
+        fitted_response = dot(W, A)
+
+        # Blend the fitted response into the measured response
+        blend_samples = int(ceil(fit_bins * self._BLEND_FRACTION))
+        blend_start = fit_bins - blend_samples
+        transition = (linspace(1, 0, blend_samples) *
+                      fitted_response[blend_start:] +
+                      linspace(0, 1, blend_samples) *
+                      log_response[blend_start:fit_bins])
+
+        return r_[fitted_response[:blend_start], transition,
+                  log_response[fit_bins:]]
+
+    def _minimumPhaseFilter(self, log_magnitude):
+        """ Determines the minimum phase compensation filter, which flattens
+            the smoothed loudspeaker response.
+
+        :param log_magnitude:
+            2 * log10 of the smoothed loudspeaker magnitude, for each bin of a
+            real FFT.
+        :type log_magnitude:
+            array of float
+
+        :returns:
+            array of float : The impulse response of the filter.
+        """
+        self.logger.debug("Entering _minimumPhaseFilter")
+
+        N = 2 * (len(log_magnitude) - 1)
+
+        # The natural logarithm of the inverse loudspeaker magnitude
+        log_inverse = -log_magnitude / 2.0 * log(10)
+
+        # Fold the cepstrum to make it causal
+        c = irfft(log_inverse, N)
+        m = r_[c[0], 2 * c[1:N / 2], c[N / 2], zeros(N / 2 - 1)]
+
+        impulse_response = irfft(exp(rfft(m)), N)
+
+        return impulse_response
+
+
+if __name__ == "__main__":
+    """ Builds the compensation filter for a loudspeaker measurement """
+    import sys
+
+    logger = logging.getLogger("Alpha")
+    logger.setLevel(logging.DEBUG)
+    ch = logging.StreamHandler()
+    ch.setLevel(logging.DEBUG)
+    logger.addHandler(ch)
+
+    compensation_filter = CompensationFilter()
+    for measurement_filename in sys.argv[1:]:
+        impulse_response = compensation_filter.buildFilter(measurement_filename)
+        print "%s: %s taps" % (measurement_filename, len(impulse_response))
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+""" Provides the excitation plan, the settings of an excitation signal parsed
+    once into typed values, along with the lengths and offsets of the parts of
+    the signal.
+
+The measurement settings are a dictionary of strings, as stored in the
+databases.  The excitation plan is compiled from the settings, and is shared by
+the signal generator, the measurement and the analysis, so that the settings
+are only parsed once, and the buffer sizes are known before the signal is
+generated.
+
+Each repetition of the signal, a period, is laid out as follows, if the signal
+is padded:
+    [0, impulse, impulse delay, signal burst, signal padding]
+otherwise the period is just the signal burst.  The signal is made up of
+signal reps + 1 periods.
+"""
+
+from numpy import ceil, dtype, float64
+
+__author__ = "Lance Jenkin"
+__email__ = "lancejenkin@gmail.com"
+
+
+class ExcitationPlan(object):
+    # The gain used if it is not given, -6 dB
+    _DEFAULT_GAIN = 0.562341325190349
+
+    _SWEEP_TYPES = ["swept sine", "low pass swept sine",
+                    "exponential swept sine"]
+    _MLS_TYPES = ["maximum length sequence", "inverse repeat sequence"]
+    # The lower frequency of an exponential swept sine, if the setting is not
+    # above 0 Hz, such as the default for the linear swept sines
+    _DEFAULT_EXPONENTIAL_LOWER_FREQUENCY = 20.0
+
+    # The signal played through each output channel, and the signal recorded
+    # by each input channel
+    OUTPUT_ROUTING = ("signal", "trigger")
+    INPUT_ROUTING = ("microphone", "generator")
+
+    def __init__(self, settings, signal_dtype=float64):
+        """ Compiles the excitation plan from the settings.
+
+        :param settings:
+            The measurement settings, or the signal settings.
+        :type settings:
+            dict
+        :param signal_dtype:
+            The data type of the signal.
+        :type signal_dtype:
+            numpy dtype
+        """
+        plan = {}
+
+        signal_type = str(settings["signal type"]).lower()
+        sample_rate = float(settings["sample rate"])
+
+        plan["signal_type"] = signal_type
+        plan["sample_rate"] = sample_rate
+        plan["dtype"] = dtype(signal_dtype)
+
+        if "gain" in settings:
+            gain = float(settings["gain"])
+            if gain <= 0:
+                # Gain is in dB; convert to decimal
+                gain = 10 ** (gain / 20.0)
+        else:
+            gain = self._DEFAULT_GAIN
+        plan["gain"] = gain
+
+        # The filters, a band pass filter is a low pass filter followed by a
+        # high pass filter
+        filters = []
+        if int(settings.get("lpf enabled", 0)) == 1:
+            filters.append(("low", int(settings["lpf cutoff"]),
+                            int(settings["lpf order"])))
+        if int(settings.get("hpf enabled", 0)) == 1:
+            filters.append(("high", int(settings["hpf cutoff"]),
+                            int(settings["hpf order"])))
+        plan["filters"] = tuple(filters)
+
+        # The filename of the loudspeaker measurement to compensate for.  The
+        # contents of the measurement are only read when the signal is
+        # generated or cached, so saved measurements can be re-analysed
+        # without it
+        compensation_filter = settings.get("compensation filter")
+        if compensation_filter:
+            plan["compensation_filter"] = str(compensation_filter)
+        else:
+            plan["compensation_filter"] = None
+
+        # Signal specific settings, and the length of the signal burst
+        plan["lower_frequency"] = None
+        plan["upper_frequency"] = None
+        plan["sweep_length"] = None
+        plan["fft_size"] = None
+        plan["mls_taps"] = None
+        plan["mls_reps"] = None
+
+        if signal_type in self._SWEEP_TYPES:
+            if "lower frequency" in settings:
+                plan["lower_frequency"] = float(settings["lower frequency"])
+            else:
+                plan["lower_frequency"] = 0.0
+            if (signal_type == "exponential swept sine" and
+                    plan["lower_frequency"] <= 0):
+                # An exponential sweep can not start from 0 Hz
+                plan["lower_frequency"] = \
+                    self._DEFAULT_EXPONENTIAL_LOWER_FREQUENCY
+            plan["upper_frequency"] = float(settings["upper frequency"])
+            plan["sweep_length"] = float(settings["signal length"])
+
+            sweep_samples = plan["sweep_length"] * sample_rate
+            if signal_type == "exponential swept sine":
+                burst_length = int(sweep_samples)
+            else:
+                # The length of arange(0, signal length, 1 / sample rate)
+                burst_length = int(ceil(plan["sweep_length"] /
+                                        (1 / sample_rate)))
+
+            if signal_type == "low pass swept sine":
+                plan["fft_size"] = int(settings["fft size"])
+                burst_length = min(burst_length, plan["fft_size"])
+        elif signal_type in self._MLS_TYPES:
+            plan["mls_taps"] = int(settings["mls taps"])
+            plan["mls_reps"] = int(settings["mls reps"])
+
+            # The sequence is repeated mls reps + 2 times
+            burst_length = (2 ** plan["mls_taps"] - 1) * (plan["mls_reps"] + 2)
+            if signal_type == "inverse repeat sequence":
+                burst_length *= 2
+        else:
+            raise Exception("Unknown signal type: %s" % (signal_type))
+
+        plan["burst_length"] = burst_length
+
+        # The layout of the periods
+        pad_signal = int(settings.get("pad signal", 0)) == 1
+
+        if "impulse delay" in settings:
+            impulse_delay = float(settings["impulse delay"])
+            impulse_delay_samples = int(impulse_delay * sample_rate)
+        else:
+            impulse_delay_samples = 0
+
+        if pad_signal:
+            signal_padding = float(settings["signal padding"])
+            signal_padding_samples = int(signal_padding * sample_rate)
+
+            # The impulse is preceded by a single zero
+            impulse_index = 1
+            signal_start = 2 + impulse_delay_samples
+        else:
+            signal_padding_samples = 0
+            impulse_index = None
+            signal_start = 0
+
+        plan["pad_signal"] = pad_signal
+        plan["impulse_index"] = impulse_index
+        plan["impulse_delay_samples"] = impulse_delay_samples
+        plan["signal_padding_samples"] = signal_padding_samples
+        plan["signal_start"] = signal_start
+        plan["signal_end"] = signal_start + burst_length
+        plan["period_length"] = plan["signal_end"] + signal_padding_samples
+        plan["period_count"] = int(settings["signal reps"]) + 1
+        plan["signal_length"] = plan["period_count"] * plan["period_length"]
+
+        plan["signal_key"] = self._signalKey(plan)
+
+        self.__dict__.update(plan)
+
+    def __setattr__(self, name, value):
+        """ The excitation plan is immutable, compile a new plan instead. """
+        raise Exception("ExcitationPlan is immutable, can not set %s" % (name))
+
+    def __eq__(self, other):
+        return (isinstance(other, ExcitationPlan) and
+                self.signal_key == other.signal_key)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.signal_key)
+
+    @staticmethod
+    def _signalKey(plan):
+        """ Determines the key of the signal described by the plan, made up of
+            only the values that affect the signal.
+
+        :param plan:
+            The values of the plan.
+        :type plan:
+            dict
+
+        :returns:
+            tuple : The key of the signal.
+        """
+        names = ["signal_type", "sample_rate", "gain", "filters",
+                 "compensation_filter", "lower_frequency",
+                 "upper_frequency", "sweep_length", "fft_size", "mls_taps",
+                 "mls_reps", "signal_start", "period_length", "period_count"]
+
+        return (plan["dtype"].str,) + tuple(plan[name] for name in names)
@@ -6,6 +6,8 @@
     the inverse Fourier Transform of the magnitude  of the Fourier Transform of
     the response, ie :
         h[n] ~= ifft[ abs[ fft[ x[n] ] ] ]  
+    If it is an exponential swept sine, the response is convolved with the
+    inverse filter of the sweep.
     If the excitation is either MLS or IRS, then the circular deconvolution 
     property of MLS-type signals are used. The generators response is 
     deconvolved from the microphone response so that the frequency response of 
@@ -17,7 +19,9 @@ import logging
 from pylab import *
 from scipy.signal import deconvolve
 
+from ExcitationPlan import ExcitationPlan
 from MlsDb import MlsDb
+from SignalGenerator import SignalGenerator
 
 __author__ = "Lance Jenkin"
 __email__ = "lancejenkin@gmail.com"
@@ -51,6 +55,7 @@ class FrequencyResponse(object):
         self.microphone_signals = microphone_signals
         self.generator_signals = generator_signals
         self.measurement_settings = measurement_settings
+        self.plan = ExcitationPlan(measurement_settings)
 
         # Create new object to access MLS database
         self.mls_db = MlsDb()
@@ -117,33 +122,33 @@ class FrequencyResponse(object):
 
         # If MLS / IRS signal is used, use the circular convolution property
         # to determine the system response.
-        signal_type = self.measurement_settings["signal type"]
+        signal_type = self.plan.signal_type
 
-        if signal_type.lower() == "maximum length sequence":
-            number_taps = int(self.measurement_settings["mls taps"])
+        if signal_type == "maximum length sequence":
+            number_taps = self.plan.mls_taps
 
-            self.microphone_response = self.mls_db.getSystemResponse(self.average_microphone_response, number_taps)
-            self.generator_response = self.mls_db.getSystemResponse(self.average_generator_response, number_taps)
-        elif signal_type.lower() == "inverse repeat sequence":
-            number_taps = int(self.measurement_settings["mls taps"])
+            responses = self.mls_db.getSystemResponses([self.average_microphone_response,
+                                                        self.average_generator_response], number_taps)
+            (self.microphone_response, self.generator_response) = responses
+        elif signal_type == "inverse repeat sequence":
+            number_taps = self.plan.mls_taps
 
             # Preform the circular convolution manually!
-            mls = self.mls_db.getMls(number_taps)
-            mls = -2 * mls + 1
-            irs = array([])
-            for index, sample in enumerate(r_[mls, mls]):
-                if index % 2 == 0:
-                    irs = r_[irs, sample]
-                else:
-                    irs = r_[irs, -1 * sample]
-
-            assert (len(self.average_microphone_response) == len(irs))
-            assert (len(self.average_generator_response) == len(irs))
-
-            self.microphone_response = ifft(fft(self.average_microphone_response) * fft(irs[-1::-1]))
-            self.microphone_response = self.microphone_response[:2 ** number_taps - 1]
-            self.generator_response = ifft(fft(self.average_generator_response) * fft(irs[-1::-1]))
-            self.generator_response = self.generator_response[:2 ** number_taps - 1]
+            irs_length = 2 * (2 ** number_taps - 1)
+            irs_spectrum = self.mls_db.getIrsSpectrum(number_taps)
+
+            assert (len(self.average_microphone_response) == irs_length)
+            assert (len(self.average_generator_response) == irs_length)
+
+            responses = irfft(rfft([self.average_microphone_response,
+                                    self.average_generator_response]) * irs_spectrum)
+            self.microphone_response = responses[0, :2 ** number_taps - 1]
+            self.generator_response = responses[1, :2 ** number_taps - 1]
+        elif signal_type == "exponential swept sine":
+            responses = SignalGenerator.deconvolveSweep(
+                [self.average_microphone_response,
+                 self.average_generator_response], self.plan)
+            (self.microphone_response, self.generator_response) = responses
         else:
             self.microphone_response = self.average_microphone_response
             self.generator_response = self.average_microphone_response
@@ -159,12 +164,10 @@ class FrequencyResponse(object):
         """
         self.logger.debug("Entering _extractSignals")
 
-        sample_rate = float(self.measurement_settings["sample rate"])
-        signal_type = str(self.measurement_settings["signal type"])
+        signal_type = self.plan.signal_type
         impulse_location = int(self.measurement_settings["microphone impulse location"])
-        impulse_signal_delay = float(self.measurement_settings["impulse delay"])
 
-        impulse_signal_samples = impulse_signal_delay * sample_rate
+        impulse_signal_samples = self.plan.impulse_delay_samples
         # Since the impulse is also a sample, we need to add one before the actual
         # start of the signal.
 
@@ -183,9 +186,9 @@ class FrequencyResponse(object):
             self.generator_responses.append(array(signal[signal_start:]))
         self.average_generator_response = average(self.generator_responses[1:], axis=0)
 
-        if signal_type.lower() == "maximum length sequence":
-            mls_reps = int(self.measurement_settings["mls reps"])
-            mls_taps = int(self.measurement_settings["mls taps"])
+        if signal_type == "maximum length sequence":
+            mls_reps = self.plan.mls_reps
+            mls_taps = self.plan.mls_taps
             assert(mls_reps > 0)
 
             mls_length = 2 ** mls_taps - 1
@@ -195,9 +198,9 @@ class FrequencyResponse(object):
             mls_sig = self.average_generator_response[mls_length:(mls_length * (mls_reps + 1))]
             mls_array = reshape(mls_sig, (mls_reps, -1))
             self.average_generator_response = average(mls_array, axis=0)
-        elif signal_type.lower() == "inverse repeat sequence":
-            mls_reps = int(self.measurement_settings["mls reps"])
-            mls_taps = int(self.measurement_settings["mls taps"])
+        elif signal_type == "inverse repeat sequence":
+            mls_reps = self.plan.mls_reps
+            mls_taps = self.plan.mls_taps
             assert(mls_reps > 0)
 
             mls_length = 2 ** mls_taps - 1
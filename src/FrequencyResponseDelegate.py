@@ -118,4 +118,5 @@ if __name__ == "__main__":
     freq_response = FrequencyResponseDelegate()
 
     app.exec_()
+    freq_response.close()
 
@@ -9,6 +9,7 @@ from pylab import *
 from scipy.fftpack import hilbert
 
 from AudioIO import AudioIO
+from ExcitationPlan import ExcitationPlan
 from SignalGenerator import SignalGenerator
 
 __author__ = "Lance Jenkin"
@@ -17,7 +18,7 @@ __email__ = "lancejenkin@gmail.com"
 
 class Measurement(object):
 
-    def __init__(self, measurement_settings):
+    def __init__(self, measurement_settings, signal_cache=None, audio=None):
         """ Constructor for Measurement object.
 
         :param measurement_settings:
@@ -25,11 +26,26 @@ class Measurement(object):
             the signal.
         :type measurement_settings:
             dict
+        :param signal_cache:
+            The cache to get the signal from.  If None, the signal is
+            generated for this measurement.
+        :type signal_cache:
+            SignalCache
+        :param audio:
+            The audio session to use for the measurement.  If None, a new
+            session is created for this measurement.
+        :type audio:
+            AudioIO
         """
         self.logger = logging.getLogger("Alpha")
         self.logger.debug("Creating Measurement Object")
 
         self.measurement_settings = measurement_settings
+        self.signal_cache = signal_cache
+        self.audio = audio
+
+        # The sound card plays single precision samples
+        self.plan = ExcitationPlan(measurement_settings, float32)
 
         self._setupAudio()
 
@@ -44,14 +60,21 @@ class Measurement(object):
         """
         self.logger.debug("Entering startMeasurement")
 
-        signal_gen = SignalGenerator(self.measurement_settings)
+        if self.signal_cache is None:
+            signal_gen = SignalGenerator(self.plan)
+            signal = signal_gen.signal
+        else:
+            signal = self.signal_cache.getSignal(self.plan)
 
-        signal = signal_gen.signal
-        trigger = [1]
-        (left, right) = self.audio.playbackAndRecord(signal, trigger)
+        # Route the signals to the output channels, and the recorded responses
+        # from the input channels
+        signals = {"signal": signal, "trigger": [1]}
+        (left, right) = self.audio.playbackAndRecord(
+            *[signals[name] for name in self.plan.OUTPUT_ROUTING])
 
-        self.microphone_response = left
-        self.generator_response = right
+        responses = dict(zip(self.plan.INPUT_ROUTING, (left, right)))
+        self.microphone_response = responses["microphone"]
+        self.generator_response = responses["generator"]
 
         self._initialAnalysis()
 
@@ -64,12 +87,14 @@ class Measurement(object):
         self.logger.debug("Entering _initialAnalysis")
 
         # Get required parameters
-        signal_reps = int(self.measurement_settings["signal reps"])
+        period_count = self.plan.period_count
+        period_length = self.plan.period_length
 
-        # 1 Signal Repetition means 2 received signals, hence the +1
-        self.microphone_signals = reshape(self.microphone_response, (signal_reps + 1, -1))
+        # 1 Signal Repetition means 2 received signals
+        self.microphone_signals = reshape(self.microphone_response,
+                                          (period_count, period_length))
         self.generator_signals = reshape(self.generator_response,
-                                        (signal_reps + 1, -1))
+                                        (period_count, period_length))
 
         # Since all signals should be located in the same place, only need to
         # locate the impulse in the first usable signal.  The first signal will generally have some distortions due to
@@ -173,9 +198,10 @@ class Measurement(object):
         """ Setup the audio device """
         self.logger.debug("Entering _setupAudio")
 
-        sample_rate = self.measurement_settings["sample rate"]
-
-        self.audio = AudioIO(sample_rate)
+        if self.audio is None:
+            self.audio = AudioIO(self.plan.sample_rate)
+        else:
+            self.audio.setSampleRate(self.plan.sample_rate)
 
         input_device = int(self.measurement_settings["input device"])
         output_device = int(self.measurement_settings["output device"])
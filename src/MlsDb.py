@@ -7,13 +7,33 @@ and also provides a method to determine the system response using the Fast
 Hadamard Transform.
 
 The MLS database is a SQLite database, with the filename "mls.db".  If it does
-not exisit, it will be created and populated automatically.
+not exisit, it will be created and populated automatically.  MLS signals with
+more than 18 taps, up to 24, are generated and saved the first time they are
+requested.
+
+The MLS signal and permutation vectors are stored as zlib compressed raw
+little-endian arrays, along with their dtype and length, so they only need to
+be decompressed to be loaded.  Databases in the older formats, of compressed
+pickles or uncompressed arrays, are migrated when opened.
+
+Optionally, the MLS signals and permutation vectors can instead be read from a
+single memory mapped table file, "mls.npy", which is built from the database.
+The table file is shared between processes through the operating system's page
+cache, rather than each process holding its own copy of the arrays.
 """
 
+from collections import OrderedDict
 import logging
-from numpy import ones, zeros, append
+from numpy.lib.format import open_memmap
+from numpy import zeros, ascontiguousarray, empty, float64, subtract, \
+                  atleast_2d, asarray, int8, int32, roll, arange, r_, \
+                  frombuffer, dtype, load, uint8, concatenate, conj, tile
+from numpy.fft import rfft, irfft
+import os
 import pickle
 import sqlite3
+import tempfile
+import threading
 import zlib
 
 __author__ = "Lance Jenkin"
@@ -21,6 +41,44 @@ __email__ = "lancejenkin@gmail.com"
 
 class MlsDb(object):
     _MLS_FILENAME = "./mls.db"
+    _MLS_MAP_FILENAME = "./mls.npy"
+
+    # Range of taps that MLS signals can be generated for
+    _MIN_TAPS = 3
+    _MAX_TAPS = 24
+
+    # Version of the database schema, stored in the user_version pragma.
+    # Version 0 stored the arrays as zlib compressed pickles, and version 1 as
+    # uncompressed raw arrays.
+    _SCHEMA_VERSION = 2
+
+    # Storage types of the MLS signal and the tag vectors
+    _MLS_DTYPE = "<i1"
+    _TAG_DTYPE = "<i4"
+
+    # MLS signals up to this many taps are generated when the database is
+    # created, larger ones are generated when they are first requested.
+    _PREBUILT_TAPS = 18
+
+    # The decoded MLS signals and tag vectors are shared by all the MlsDb
+    # objects in the process.  The cache is keyed by the number of taps, with
+    # each entry a dictionary of the arrays decoded so far.  If a limit is set
+    # the least recently used entries are evicted to stay below it.
+    _cache = OrderedDict()
+    _cache_lock = threading.RLock()
+    _cache_max_bytes = None
+
+    # Absolute paths of the databases whose schema has been checked
+    _ready_databases = set()
+
+    # The memory mapped table file is a byte array, starting with an index of
+    # the offset of each tap count's block (0 if it is not present).  Each
+    # block contains the MLS signal, padded to a multiple of 8 bytes, followed
+    # by tag_r and tag_s.
+    _memory_mapped = False
+    _table_map = None
+    _MAP_INDEX_DTYPE = "<i8"
+    _MAP_INDEX_BYTES = 8 * (_MAX_TAPS + 1)
 
     def __init__(self):
         """ Constructor to create a MlsDb object."""
@@ -36,9 +94,326 @@ class MlsDb(object):
         
         self.conn.row_factory = self._dict_factory
 
-        self._setupDatabase()
+        # Only check the schema the first time each database is opened, the
+        # filename is relative to the working directory, which may change
+        database_path = os.path.abspath(self._MLS_FILENAME)
+        with self._cache_lock:
+            if database_path not in MlsDb._ready_databases:
+                self._setupDatabase()
+                MlsDb._ready_databases.add(database_path)
+
+    @classmethod
+    def setCacheLimit(cls, max_bytes):
+        """ Limits the memory used by the decoded MLS signals and tag vectors.
+
+        :param max_bytes:
+            The maximum number of bytes to keep cached, or None for no limit.
+        :type max_bytes:
+            int
+        """
+        with cls._cache_lock:
+            cls._cache_max_bytes = max_bytes
+            cls._evictCache()
+
+    @classmethod
+    def setMemoryMapped(cls, memory_mapped):
+        """ Selects whether the MLS signals and tag vectors are read from the
+        memory mapped table file, instead of the database.
+
+        :param memory_mapped:
+            True to use the memory mapped table file.
+        :type memory_mapped:
+            bool
+        """
+        with cls._cache_lock:
+            cls._memory_mapped = memory_mapped
+            cls._table_map = None
+            cls._cache.clear()
+
+    @classmethod
+    def clearCache(cls):
+        """ Removes all the decoded MLS signals and tag vectors from the
+        cache.
+        """
+        with cls._cache_lock:
+            cls._cache.clear()
+
+    @classmethod
+    def _evictCache(cls):
+        """ Evicts the least recently used entries until the cache is within
+        its limit.  The most recently used entry is always kept.
+        """
+        if cls._cache_max_bytes is None:
+            return
+
+        cache_bytes = lambda: sum(array.nbytes
+                                  for entry in cls._cache.values()
+                                  for array in entry.values())
+
+        while len(cls._cache) > 1 and cache_bytes() > cls._cache_max_bytes:
+            cls._cache.popitem(last=False)
+
+    def _getArray(self, number_taps, name):
+        """ Returns the decoded array of the MLS with the specified number of
+        taps, from the cache if it has already been decoded.
+
+        The returned arrays are shared, and are therefore read only.
+
+        :param number_taps:
+            The number of taps used to generate the MLS signal.
+        :type number_taps:
+            int
+        :param name:
+            The array to return, one of "mls", "tag_r" or "tag_s".
+        :type name:
+            str
+
+        :returns:
+            array : The requested array.
+        """
+        return self._getCached(number_taps, name, self._loadArray)
+
+    def _getCached(self, number_taps, name, loader):
+        """ Returns the named array of the MLS with the specified number of
+        taps from the cache, creating it with the loader if it is not cached.
+
+        :param number_taps:
+            The number of taps used to generate the MLS signal.
+        :type number_taps:
+            int
+        :param name:
+            The name of the array in the cache entry.
+        :type name:
+            str
+        :param loader:
+            Function called with the number of taps and name to create the
+            array.
+        :type loader:
+            function
+
+        :returns:
+            array : The requested array, which is read only.
+        """
+        with self._cache_lock:
+            entry = self._cache.get(number_taps, {})
+
+            if name not in entry:
+                array = loader(number_taps, name)
+                array.flags.writeable = False
+
+                # The loader may have cached other arrays of the MLS, such as
+                # the MLS signal, so add the array to the current entry
+                entry = self._cache.get(number_taps, {})
+                entry[name] = array
+
+            # Re-insert the entry to mark it as the most recently used
+            self._cache.pop(number_taps, None)
+            self._cache[number_taps] = entry
+
+            self._evictCache()
+
+            return entry[name]
+
+    def _loadArray(self, number_taps, name):
+        """ Loads an array of the MLS with the specified number of taps, either
+        from the memory mapped table file or the database.
+
+        :param number_taps:
+            The number of taps used to generate the MLS signal.
+        :type number_taps:
+            int
+        :param name:
+            The array to load, one of "mls", "tag_r" or "tag_s".
+        :type name:
+            str
+
+        :returns:
+            array : The requested array.
+        """
+        if self._memory_mapped:
+            return self._loadMappedArray(number_taps, name)
+        else:
+            return self._loadDatabaseArray(number_taps, name)
+
+    def _loadMappedArray(self, number_taps, name):
+        """ Loads an array of the MLS with the specified number of taps from
+        the memory mapped table file.  If the table file does not exist, or
+        does not contain the MLS, it is (re)built from the database.
+
+        :param number_taps:
+            The number of taps used to generate the MLS signal.
+        :type number_taps:
+            int
+        :param name:
+            The array to load, one of "mls", "tag_r" or "tag_s".
+        :type name:
+            str
+
+        :returns:
+            array : The requested array, as a view of the table file.
+        """
+        self.logger.debug("Entering _loadMappedArray (%s, %s)" %
+                          (number_taps, name))
+
+        self._ensureMls(number_taps)
+
+        if MlsDb._table_map is None and os.path.exists(self._MLS_MAP_FILENAME):
+            MlsDb._table_map = load(self._MLS_MAP_FILENAME, mmap_mode="r")
+
+        if (MlsDb._table_map is None or
+                self._mapOffsets(MlsDb._table_map)[number_taps] == 0):
+            self._buildTableMap(number_taps)
+            MlsDb._table_map = load(self._MLS_MAP_FILENAME, mmap_mode="r")
+
+        # Plain array views of the map, rather than memmap objects
+        table_map = asarray(MlsDb._table_map)
+        offset = self._mapOffsets(table_map)[number_taps]
+        length = 2 ** number_taps - 1
+        tag_bytes = length * dtype(self._TAG_DTYPE).itemsize
+
+        if name == "mls":
+            array = table_map[offset:offset + length]
+            return array.view(self._MLS_DTYPE)
+
+        offset += self._padLength(length)
+        if name == "tag_s":
+            offset += tag_bytes
+
+        return table_map[offset:offset + tag_bytes].view(self._TAG_DTYPE)
+
+    def _buildTableMap(self, number_taps):
+        """ Writes the memory mapped table file, with the MLS signals and tag
+        vectors of the prebuilt tap counts, those already in the table file,
+        and the specified number of taps.
+
+        The table file is written to a temporary file first, and then renamed,
+        so other processes mapping the old table file are not affected.  The
+        temporary file is unique, so processes building the table file at the
+        same time do not overwrite each other's.
+
+        :param number_taps:
+            The number of taps of the MLS that must be in the table file.
+        :type number_taps:
+            int
+        """
+        self.logger.info("Building MLS table file")
+
+        tap_counts = set(range(self._MIN_TAPS, self._PREBUILT_TAPS + 1))
+        tap_counts.add(number_taps)
+        if MlsDb._table_map is not None:
+            offsets = self._mapOffsets(MlsDb._table_map)
+            tap_counts.update(taps for taps in range(len(offsets))
+                              if offsets[taps] != 0)
+
+        tag_itemsize = dtype(self._TAG_DTYPE).itemsize
+
+        # Determine the offset of each block
+        offsets = zeros(self._MAX_TAPS + 1, dtype=self._MAP_INDEX_DTYPE)
+        total_bytes = self._MAP_INDEX_BYTES
+        for taps in sorted(tap_counts):
+            length = 2 ** taps - 1
+            offsets[taps] = total_bytes
+            total_bytes += self._padLength(length) + 2 * length * tag_itemsize
+
+        map_directory = os.path.dirname(os.path.abspath(self._MLS_MAP_FILENAME))
+        (handle, temporary_filename) = tempfile.mkstemp(suffix=".tmp",
+                                                        prefix="mls",
+                                                        dir=map_directory)
+        os.close(handle)
+
+        try:
+            # Created private to this user, the table file is shared
+            os.chmod(temporary_filename, 0o644)
+
+            table_map = open_memmap(temporary_filename, mode="w+", dtype=uint8,
+                                    shape=(total_bytes, ))
+
+            table_map[:self._MAP_INDEX_BYTES] = offsets.view(uint8)
+            for taps in sorted(tap_counts):
+                length = 2 ** taps - 1
+                offset = offsets[taps]
+
+                for name in ("mls", "tag_r", "tag_s"):
+                    array = self._loadDatabaseArray(taps, name).view(uint8)
+                    table_map[offset:offset + len(array)] = array
+                    if name == "mls":
+                        offset += self._padLength(length)
+                    else:
+                        offset += len(array)
+
+            table_map.flush()
+            del table_map
+
+            # Windows can not rename over an existing file
+            if os.name == "nt" and os.path.exists(self._MLS_MAP_FILENAME):
+                MlsDb._table_map = None
+                os.remove(self._MLS_MAP_FILENAME)
+            os.rename(temporary_filename, self._MLS_MAP_FILENAME)
+        except:
+            if os.path.exists(temporary_filename):
+                os.remove(temporary_filename)
+            raise
+
+    def _mapOffsets(self, table_map):
+        """ Returns the index of block offsets of the memory mapped table file.
+
+        :param table_map:
+            The memory mapped table file.
+        :type table_map:
+            array of uint8
+
+        :returns:
+            array of int : The offset of each tap count's block.
+        """
+        return table_map[:self._MAP_INDEX_BYTES].view(self._MAP_INDEX_DTYPE)
+
+    @staticmethod
+    def _padLength(length):
+        """ Rounds the length up to a multiple of 8 bytes. """
+        return (length + 7) // 8 * 8
+
+    def _loadDatabaseArray(self, number_taps, name):
+        """ Loads and decodes an array of the MLS with the specified number of
+        taps from the database.
+
+        :param number_taps:
+            The number of taps used to generate the MLS signal.
+        :type number_taps:
+            int
+        :param name:
+            The array to load, one of "mls", "tag_r" or "tag_s".
+        :type name:
+            str
+
+        :returns:
+            array : The requested array.
+        """
+        self.logger.debug("Entering _loadDatabaseArray (%s, %s)" %
+                          (number_taps, name))
+
+        self._ensureMls(number_taps)
+
+        cursor = self.conn.cursor()
+
+        if name == "mls":
+            dtype_column = "mls_dtype"
+        else:
+            dtype_column = "tag_dtype"
+
+        cursor.execute("""SELECT %s AS data, %s AS dtype, length FROM mls
+                       WHERE number_taps = ?""" % (name, dtype_column),
+                       (number_taps, ))
+
+        row = cursor.fetchone()
+
+        cursor.close()
+
+        array = frombuffer(zlib.decompress(row["data"]),
+                           dtype=dtype(str(row["dtype"])), count=row["length"])
+
+        return array
     
-    def getSystemResponse(self, response, number_taps):
+    def getSystemResponse(self, response, number_taps, method="fht"):
         """ Determines the impulse of the response of the system, which has been
         excited by a mls signal, with the specified number of taps.
         
@@ -48,6 +423,10 @@ class MlsDb(object):
         succession, with the first burst used to bring the system into a stable
         state, and the second burst used to determine the impulse response of
         the system.
+
+        The circular cross-correlation can either be determined using the Fast
+        Hadamard Transform, or using the FFT of the MLS signal.  Both give the
+        same response, up to rounding errors.
         
         :param response:
             The response recorded from the system, needs to be of length 
@@ -58,6 +437,11 @@ class MlsDb(object):
             The number of taps used to generate the MLS signal.
         :type number_taps:
             int
+        :param method:
+            The method used to determine the response, either "fht" for the
+            Fast Hadamard Transform, or "fft" for the FFT.
+        :type method:
+            str
         
         :returns:
             The system response.
@@ -69,15 +453,11 @@ class MlsDb(object):
             return
             
         response = response[:2 ** number_taps - 1]
-        cursor = self.conn.cursor()
-        
-        cursor.execute("""SELECT tag_r, tag_s FROM mls
-                       WHERE number_taps = ?""", (number_taps, ))
 
-        row = cursor.fetchone()
-        
-        tag_r = pickle.loads(zlib.decompress(row["tag_r"]))
-        tag_s = pickle.loads(zlib.decompress(row["tag_s"]))
+        if method == "fft":
+            return self._correlate(response, number_taps)
+
+        (tag_r, tag_s) = self._getTags(number_taps)
         
         permuatation = self._permutateSignal(response, tag_s)
         transformed_signal = self._fht(permuatation, number_taps)
@@ -85,6 +465,149 @@ class MlsDb(object):
         response = self._permutateResponse(transformed_signal, tag_r)
         
         return response
+
+    def getSystemResponses(self, responses, number_taps, method="fht"):
+        """ Determines the impulse responses of several responses of the
+        system, which has been excited by a mls signal, with the specified
+        number of taps.
+
+        This is the batched equivalent of getSystemResponse.  Each row of
+        responses is treated as a separate response, for instance the
+        microphone and generator channels, or the individual repetitions of
+        the MLS signal.  The permutation, Fast Hadamard Transform and inverse
+        permutation are preformed on all the rows at once.
+
+        :param responses:
+            The responses recorded from the system, with one response per row.
+            Each row needs to be of length 2 ^ (number_taps) - 1
+        :type responses:
+            2-D array of float
+        :param number_taps:
+            The number of taps used to generate the MLS signal.
+        :type number_taps:
+            int
+        :param method:
+            The method used to determine the responses, either "fht" for the
+            Fast Hadamard Transform, or "fft" for the FFT.
+        :type method:
+            str
+
+        :returns:
+            2-D array of float : The system responses, one per row.
+        """
+        self.logger.debug("Entering getSystemResponses")
+
+        responses = atleast_2d(responses)
+        mls_length = 2 ** number_taps - 1
+
+        if responses.shape[1] < mls_length:
+            self.logger.error("Reponses too short")
+            return
+
+        responses = responses[:, :mls_length]
+
+        if method == "fft":
+            return self._correlate(responses, number_taps)
+
+        (tag_r, tag_s) = self._getTags(number_taps)
+
+        permutation = self._permutateSignal(responses, tag_s)
+        transformed_signals = self._fht(permutation, number_taps)
+
+        system_responses = self._permutateResponse(transformed_signals, tag_r)
+
+        return system_responses
+
+    def _correlate(self, responses, number_taps):
+        """ Determines the system response by circularly cross-correlating the
+        responses with the MLS signal, using the FFT.
+
+        With the MLS signal, m, using {0, 1} and of length N, the system
+        response is
+            h[k] = -2 / (N + 1) * sum(y[j + k] * m[j])
+        where the indices are modulo N, which is the same response given by
+        the Fast Hadamard Transform.  The circular cross-correlation is
+        computed as a linear cross-correlation of the periodically extended
+        response, so that a power of 2 FFT length can be used, as N itself is
+        often prime.
+
+        :param responses:
+            The responses recorded from the system, of length
+            2 ^ (number_taps) - 1.  If a 2-D array, each row is a response.
+        :type responses:
+            array of float
+        :param number_taps:
+            The number of taps used to generate the MLS signal.
+        :type number_taps:
+            int
+
+        :returns:
+            array of float : The system responses, the same length as those
+            given by the Fast Hadamard Transform.
+        """
+        self.logger.debug("Entering _correlate")
+
+        mls_length = 2 ** number_taps - 1
+        fft_size = 2 ** (number_taps + 1)
+
+        mls_spectrum = self._getCached(number_taps, "mls_spectrum",
+                                       self._mlsSpectrum)
+
+        responses = asarray(responses)
+        extended = concatenate((responses, responses[..., :-1]), axis=-1)
+
+        correlation = irfft(rfft(extended, fft_size) * mls_spectrum, fft_size)
+
+        system_responses = zeros(responses.shape[:-1] + (mls_length + 1, ))
+        system_responses[..., :-1] = correlation[..., :mls_length]
+
+        return system_responses
+
+    def _mlsSpectrum(self, number_taps, name):
+        """ Determines the scaled, conjugated spectrum of the MLS signal used
+        by _correlate.
+
+        :param number_taps:
+            The number of taps used to generate the MLS signal.
+        :type number_taps:
+            int
+        :param name:
+            The name of the cache entry, unused.
+        :type name:
+            str
+
+        :returns:
+            array of complex : The spectrum of the MLS signal.
+        """
+        self.logger.debug("Entering _mlsSpectrum (%s)" % (number_taps))
+
+        mls_length = 2 ** number_taps - 1
+        fft_size = 2 ** (number_taps + 1)
+
+        mls_signal = self.getMls(number_taps)
+        mls_spectrum = conj(rfft(mls_signal, fft_size))
+        mls_spectrum *= -2.0 / (mls_length + 1)
+
+        return mls_spectrum
+
+    def _getTags(self, number_taps):
+        """ Retrieves the permutation vectors for the MLS signal with the
+        specified number of taps.
+
+        :param number_taps:
+            The number of taps used to generate the MLS signal.
+        :type number_taps:
+            int
+
+        :returns:
+            tuple : a two-tuple of the tag_r and tag_s vectors.
+        """
+        self.logger.debug("Entering _getTags (%s)" % (number_taps))
+
+        tag_r = self._getArray(number_taps, "tag_r")
+        tag_s = self._getArray(number_taps, "tag_s")
+
+        return (tag_r, tag_s)
     
     def _setupDatabase(self):
         """ Ensures that the MLS table exisits, if it does not, then creates 
@@ -103,49 +626,195 @@ class MlsDb(object):
         
         if row["mls_count"] == 0:
             self.logger.debug("Creating MLS table")
-            cursor.execute("""CREATE TABLE "mls" 
-                        ("id" INTEGER PRIMARY KEY  NOT NULL  UNIQUE, 
-                         "mls" BLOB, "tag_r" BLOB, "tag_s" BLOB,
-                         "number_taps" INTEGER)""")
+            self._createTable(cursor)
         
             self.conn.commit()   
         
             self._rebuildDatabase()
+        else:
+            cursor.execute("PRAGMA user_version")
+            row = cursor.fetchone()
+
+            if row["user_version"] < self._SCHEMA_VERSION:
+                self._migrateDatabase(row["user_version"])
+
+        cursor.close()
+
+    def _createTable(self, cursor):
+        """ Creates the MLS table, and marks the database with the current
+            schema version.
+
+        :param cursor:
+            The cursor used to create the table.
+        :type cursor:
+            sqlite3.Cursor
+        """
+        self.logger.debug("Entering _createTable")
+
+        cursor.execute("""CREATE TABLE "mls" 
+                    ("id" INTEGER PRIMARY KEY  NOT NULL  UNIQUE, 
+                     "number_taps" INTEGER UNIQUE, "length" INTEGER,
+                     "mls" BLOB, "mls_dtype" TEXT,
+                     "tag_r" BLOB, "tag_s" BLOB, "tag_dtype" TEXT)""")
+
+        cursor.execute("PRAGMA user_version = %d" % (self._SCHEMA_VERSION))
+
+    def _migrateDatabase(self, version):
+        """ Migrates a database storing the MLS signals and tag vectors as
+            zlib compressed pickles of float arrays, or as uncompressed raw
+            arrays, to the compressed raw array format.
+
+        :param version:
+            The schema version of the database.
+        :type version:
+            int
+        """
+        self.logger.info("Migrating MLS database to compressed raw arrays")
+
+        cursor = self.conn.cursor()
+
+        cursor.execute("""ALTER TABLE "mls" RENAME TO "mls_pickled" """)
+        self._createTable(cursor)
 
+        cursor.execute("SELECT number_taps FROM mls_pickled")
+        tap_counts = [row["number_taps"] for row in cursor.fetchall()]
+
+        for number_taps in tap_counts:
+            cursor.execute("""SELECT * FROM mls_pickled
+                           WHERE number_taps = ?""", (number_taps, ))
+            row = cursor.fetchone()
+
+            if version == 0:
+                mls_signal = pickle.loads(zlib.decompress(row["mls"]))
+                tag_r = pickle.loads(zlib.decompress(row["tag_r"]))
+                tag_s = pickle.loads(zlib.decompress(row["tag_s"]))
+            else:
+                mls_signal = frombuffer(row["mls"],
+                                        dtype=str(row["mls_dtype"]))
+                tag_r = frombuffer(row["tag_r"], dtype=str(row["tag_dtype"]))
+                tag_s = frombuffer(row["tag_s"], dtype=str(row["tag_dtype"]))
+
+            self._insertArrays(cursor, number_taps, mls_signal, tag_r, tag_s)
+
+        cursor.execute("""DROP TABLE "mls_pickled" """)
+
+        self.conn.commit()
+
+        # Reclaim the space used by the pickled arrays
+        cursor.execute("VACUUM")
         cursor.close()
     
     def _rebuildDatabase(self):
         """ Populates the MLS database with MLS signals from 3 taps to 18.
 
-        Generates MLS signals for all valid tap configurations available,
+        Generates MLS signals for the commonly used tap configurations,
         (3 to 18).  Along with the MLS, generates the tag_s and tag_r vectors
         used to permutate the signal and response for the Fast Hadamard 
-        Transform.
+        Transform.  MLS signals with more taps are added by _ensureMls when
+        they are first needed.
         """
         self.logger.debug("Entering rebuild_database")
         
         cursor = self.conn.cursor()
         
-        for number_taps in range(3, 18 + 1):
-            self.logger.debug("Generating MLS, tag_s, tag_r with %d taps" % 
-                                (number_taps) )
-                                
-            mls_signal = self._generateMls(number_taps)
-            tag_s = self._generateTagS(mls_signal, number_taps)
-            tag_r = self._generateTagR(mls_signal, number_taps)
-            
-            compressed_mls = buffer(zlib.compress(pickle.dumps(mls_signal), 9))
-            compressed_tag_s = buffer(zlib.compress(pickle.dumps(tag_s), 9))
-            compressed_tag_r = buffer(zlib.compress(pickle.dumps(tag_r),9 ))
-            
-            cursor.execute("""INSERT INTO mls (mls, tag_s, tag_r, number_taps) 
-                        VALUES (?, ?, ?, ?)""", (compressed_mls, 
-                                                compressed_tag_s,
-                                                compressed_tag_r,
-                                                number_taps) )
+        for number_taps in range(self._MIN_TAPS, self._PREBUILT_TAPS + 1):
+            self._insertMls(cursor, number_taps)
         
         self.conn.commit()   
         cursor.close()
+
+    def _ensureMls(self, number_taps):
+        """ Ensures that the MLS signal with the specified number of taps is in
+        the database, generating and saving it if it is not.
+
+        Raises an Exception if the number of taps is not supported.
+
+        :param number_taps:
+            The number of taps used to generate the MLS signal.
+        :type number_taps:
+            int
+        """
+        self.logger.debug("Entering _ensureMls (%s)" % (number_taps))
+
+        if not self._MIN_TAPS <= number_taps <= self._MAX_TAPS:
+            self.logger.error("Unsupported number of taps: %s" % (number_taps))
+            raise Exception("MLS taps must be between %d and %d" %
+                            (self._MIN_TAPS, self._MAX_TAPS))
+
+        cursor = self.conn.cursor()
+
+        cursor.execute("""SELECT COUNT(id) AS mls_count FROM mls
+                       WHERE number_taps = ?""", (number_taps, ))
+
+        row = cursor.fetchone()
+
+        if row["mls_count"] == 0:
+            self.logger.info("Generating MLS with %d taps" % (number_taps))
+
+            self._insertMls(cursor, number_taps)
+            self.conn.commit()
+
+        cursor.close()
+
+    def _insertMls(self, cursor, number_taps):
+        """ Generates the MLS signal, tag_s and tag_r vectors with the
+        specified number of taps, and inserts them into the database.
+
+        :param cursor:
+            The cursor used to insert the MLS.
+        :type cursor:
+            sqlite3.Cursor
+        :param number_taps:
+            The number of taps used to generate the MLS signal.
+        :type number_taps:
+            int
+        """
+        self.logger.debug("Generating MLS, tag_s, tag_r with %d taps" % 
+                            (number_taps) )
+                            
+        mls_signal = self._generateMls(number_taps)
+        tag_s = self._generateTagS(mls_signal, number_taps)
+        tag_r = self._generateTagR(mls_signal, number_taps)
+
+        self._insertArrays(cursor, number_taps, mls_signal, tag_r, tag_s)
+
+    def _insertArrays(self, cursor, number_taps, mls_signal, tag_r, tag_s):
+        """ Inserts the MLS signal and tag vectors into the database as zlib
+        compressed raw little-endian arrays.
+
+        :param cursor:
+            The cursor used to insert the MLS.
+        :type cursor:
+            sqlite3.Cursor
+        :param number_taps:
+            The number of taps used to generate the MLS signal.
+        :type number_taps:
+            int
+        :param mls_signal:
+            The MLS signal using {0, 1}.
+        :type mls_signal:
+            array of int
+        :param tag_r:
+            The Tag R vector.
+        :type tag_r:
+            array of int
+        :param tag_s:
+            The Tag S vector.
+        :type tag_s:
+            array of int
+        """
+        raw_mls = asarray(mls_signal, dtype=self._MLS_DTYPE).tostring()
+        raw_tag_r = asarray(tag_r, dtype=self._TAG_DTYPE).tostring()
+        raw_tag_s = asarray(tag_s, dtype=self._TAG_DTYPE).tostring()
+
+        raw_mls = buffer(zlib.compress(raw_mls))
+        raw_tag_r = buffer(zlib.compress(raw_tag_r))
+        raw_tag_s = buffer(zlib.compress(raw_tag_s))
+        
+        cursor.execute("""INSERT INTO mls (number_taps, length, mls, mls_dtype,
+                    tag_r, tag_s, tag_dtype) VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                    (number_taps, len(mls_signal), raw_mls, self._MLS_DTYPE,
+                     raw_tag_r, raw_tag_s, self._TAG_DTYPE))
     
     def getMls(self, number_taps):
         """ Returns the MLS signal with the specified number of taps.
@@ -156,24 +825,99 @@ class MlsDb(object):
             int
         
         :returns:
-            array of int : The MLS signal using {0, 1}
+            array of int8 : The MLS signal using {0, 1}.  The array is shared
+            with the other MlsDb objects, and is read only.
 
         """
         self.logger.debug("Entering getMls (%s)"%(number_taps))
-        
-        cursor = self.conn.cursor()
-        
-        cursor.execute("SELECT mls FROM mls WHERE number_taps = ?",
-                        (number_taps, ) )
-        
-        row = cursor.fetchone()
-        
-        cursor.close()
 
-        mls_signal = pickle.loads(zlib.decompress((row["mls"])))
+        mls_signal = self._getArray(number_taps, "mls")
         
         return mls_signal
 
+    def getIrs(self, number_taps):
+        """ Returns the Inverse Repeat Sequence (IRS) formed from the MLS signal
+        with the specified number of taps.
+
+        The IRS is two periods of the MLS signal, mapped from {0, 1} to
+        {+1, -1}, with every odd sample inverted:
+            x[n] = s[n]     n is even
+            x[n] = -s[n]    n is odd
+
+        :param number_taps:
+            The number of taps used to generate the MLS signal.
+        :type number_taps:
+            int
+
+        :returns:
+            array of float : The IRS signal, of length 2 * (2 ^ number_taps - 1).
+            The array is shared with the other MlsDb objects, and is read
+            only.
+        """
+        self.logger.debug("Entering getIrs (%s)" % (number_taps))
+
+        return self._getCached(number_taps, "irs", self._generateIrs)
+
+    def getIrsSpectrum(self, number_taps):
+        """ Returns the real FFT of the time reversed IRS signal, so that the
+        circular cross-correlation of a response, y, with the IRS is
+            irfft(rfft(y) * getIrsSpectrum(number_taps))
+
+        :param number_taps:
+            The number of taps used to generate the MLS signal.
+        :type number_taps:
+            int
+
+        :returns:
+            array of complex : The spectrum of the time reversed IRS.  The
+            array is shared with the other MlsDb objects, and is read only.
+        """
+        self.logger.debug("Entering getIrsSpectrum (%s)" % (number_taps))
+
+        return self._getCached(number_taps, "irs_spectrum", self._irsSpectrum)
+
+    def _generateIrs(self, number_taps, name):
+        """ Generates the IRS signal for getIrs.
+
+        :param number_taps:
+            The number of taps used to generate the MLS signal.
+        :type number_taps:
+            int
+        :param name:
+            The name of the cache entry, unused.
+        :type name:
+            str
+
+        :returns:
+            array of float : The IRS signal.
+        """
+        mls_signal = -2.0 * self.getMls(number_taps) + 1
+
+        irs = tile(mls_signal, 2)
+        irs[1::2] *= -1
+
+        return irs
+
+    def _irsSpectrum(self, number_taps, name):
+        """ Determines the spectrum of the time reversed IRS signal for
+        getIrsSpectrum.
+
+        :param number_taps:
+            The number of taps used to generate the MLS signal.
+        :type number_taps:
+            int
+        :param name:
+            The name of the cache entry, unused.
+        :type name:
+            str
+
+        :returns:
+            array of complex : The spectrum of the time reversed IRS.
+        """
+        irs = self.getIrs(number_taps)
+
+        return rfft(irs[::-1])
+
     def _generateMls(self, number_taps):
         """Generate a Maximum Length Sequence with a specified number of taps.
             
@@ -189,58 +933,128 @@ class MlsDb(object):
         """
         self.logger.debug("Entering _generateMls (%s)"%(number_taps))
         
-        MAX_TAPS = 18 # Maximum number of taps in table
-        if number_taps > MAX_TAPS:
-            self.logger.info("Maximum number of taps is 18, using 18 taps")
-            number_taps = 18
-        if number_taps < 3:
-            self.logger.info("Minimum number of taps is 3, using 3 taps")
-            number_taps = 3
+        if number_taps > self._MAX_TAPS:
+            self.logger.info("Maximum number of taps is %d, using %d taps" %
+                             (self._MAX_TAPS, self._MAX_TAPS))
+            number_taps = self._MAX_TAPS
+        if number_taps < self._MIN_TAPS:
+            self.logger.info("Minimum number of taps is %d, using %d taps" %
+                             (self._MIN_TAPS, self._MIN_TAPS))
+            number_taps = self._MIN_TAPS
         
         # Due to the difficulty in calculating primitive polynomials, the
         # following taps table is taken from:
         # Impulse response measuremnts using MLS - Jens Hee,
         # url: http://jenshee.dk
+        # The taps from 19 to 24 are from the table of maximum length LFSR
+        # taps in Xilinx application note XAPP052.
 
     
         taps_table = [
-                [0,1,1,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0], # taps = 3
-                [0,0,1,1,0,0,0,0,0,0,0,0,0,0,0,0,0,0], # taps = 4
-                [0,0,1,0,1,0,0,0,0,0,0,0,0,0,0,0,0,0], # taps = 5
-                [0,0,0,0,1,1,0,0,0,0,0,0,0,0,0,0,0,0], # taps = 6
-                [0,0,0,1,0,0,1,0,0,0,0,0,0,0,0,0,0,0], # taps = 7 
-                [0,0,0,1,1,1,0,1,0,0,0,0,0,0,0,0,0,0], # taps = 8
-                [0,0,0,0,1,0,0,0,1,0,0,0,0,0,0,0,0,0], # taps = 9
-                [0,0,0,0,0,0,1,0,0,1,0,0,0,0,0,0,0,0], # taps = 10
-                [0,0,0,0,0,0,0,0,1,0,1,0,0,0,0,0,0,0], # taps = 11
-                [0,0,0,0,0,1,0,1,0,0,1,1,0,0,0,0,0,0], # taps = 12
-                [0,0,0,0,0,0,0,0,1,1,0,1,1,0,0,0,0,0], # taps = 13
-                [0,0,0,1,0,0,0,1,0,0,0,0,1,1,0,0,0,0], # taps = 14
-                [0,0,0,0,0,0,0,0,0,0,0,0,0,1,1,0,0,0], # taps = 15
-                [0,0,0,1,0,0,0,0,0,0,0,0,1,0,1,1,0,0], # taps = 16
-                [0,0,0,0,0,0,0,0,0,0,0,0,0,1,0,0,1,0], # taps = 17
-                [0,0,0,0,0,0,0,0,0,0,1,0,0,0,0,0,0,1]  # taps = 18
+                [0,1,1,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0], # taps = 3
+                [0,0,1,1,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0], # taps = 4
+                [0,0,1,0,1,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0], # taps = 5
+                [0,0,0,0,1,1,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0], # taps = 6
+                [0,0,0,1,0,0,1,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0], # taps = 7
+                [0,0,0,1,1,1,0,1,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0], # taps = 8
+                [0,0,0,0,1,0,0,0,1,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0], # taps = 9
+                [0,0,0,0,0,0,1,0,0,1,0,0,0,0,0,0,0,0,0,0,0,0,0,0], # taps = 10
+                [0,0,0,0,0,0,0,0,1,0,1,0,0,0,0,0,0,0,0,0,0,0,0,0], # taps = 11
+                [0,0,0,0,0,1,0,1,0,0,1,1,0,0,0,0,0,0,0,0,0,0,0,0], # taps = 12
+                [0,0,0,0,0,0,0,0,1,1,0,1,1,0,0,0,0,0,0,0,0,0,0,0], # taps = 13
+                [0,0,0,1,0,0,0,1,0,0,0,0,1,1,0,0,0,0,0,0,0,0,0,0], # taps = 14
+                [0,0,0,0,0,0,0,0,0,0,0,0,0,1,1,0,0,0,0,0,0,0,0,0], # taps = 15
+                [0,0,0,1,0,0,0,0,0,0,0,0,1,0,1,1,0,0,0,0,0,0,0,0], # taps = 16
+                [0,0,0,0,0,0,0,0,0,0,0,0,0,1,0,0,1,0,0,0,0,0,0,0], # taps = 17
+                [0,0,0,0,0,0,0,0,0,0,1,0,0,0,0,0,0,1,0,0,0,0,0,0], # taps = 18
+                [1,1,0,0,1,0,0,0,0,0,0,0,0,0,0,0,0,0,1,0,0,0,0,0], # taps = 19
+                [0,0,1,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,1,0,0,0,0], # taps = 20
+                [0,1,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,1,0,0,0], # taps = 21
+                [1,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,1,0,0], # taps = 22
+                [0,0,0,0,1,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,1,0], # taps = 23
+                [1,1,0,0,0,0,1,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,1]  # taps = 24
                 ]
     
-        # Initialize Variables
+        # The delay line starts as all ones, and each new sample is the sum
+        # (mod 2) of the tapped samples of the delay line, so the MLS follows
+        # the recurrence
+        #     mls[j] = sum(mls[j - 1 - i] for the taps i) mod 2
+        # with a characteristic polynomial, stored as a bit mask, of
+        #     p(x) = x ^ number_taps + sum(x ^ (number_taps - 1 - i))
         length = 2 ** number_taps - 1
-        mls_signal = []
-        delay_line = ones(number_taps)
         filter_taps = taps_table[number_taps - 3]
-    
-        for signal_index in range(length):
-            sum = 0
-            for tap_index in range(number_taps):
-                sum += filter_taps[tap_index] * delay_line[tap_index]
-            sum = sum % 2
-    
-            mls_signal = append(mls_signal, delay_line[number_taps - 1])
-    
-            for delay_index in range(number_taps - 1, 0, -1):
-                delay_line[delay_index] = delay_line[delay_index - 1]
-            delay_line[0] = sum
-    
+
+        polynomial = 1 << number_taps
+        for tap_index in range(number_taps):
+            if filter_taps[tap_index] == 1:
+                polynomial |= 1 << (number_taps - 1 - tap_index)
+
+        mls_signal = zeros(length, dtype=int8)
+        mls_signal[:number_taps] = 1
+
+        # Given the first known samples, the next samples are found by
+        #     mls[j + known] = sum(c_k * mls[j + k]) mod 2
+        # where x ^ known = sum(c_k * x ^ k) mod p(x), which is valid as long
+        # as j + k < known, so the number of known samples nearly doubles on
+        # every pass.
+        known = number_taps
+        while known < length:
+            block_length = min(known - number_taps + 1, length - known)
+            block = mls_signal[known:known + block_length]
+
+            coefficients = self._powerModPolynomial(known, polynomial,
+                                                    number_taps)
+            for k in range(number_taps):
+                if (coefficients >> k) & 1:
+                    block ^= mls_signal[k:k + block_length]
+
+            known += block_length
+
         return mls_signal
+
+    @staticmethod
+    def _powerModPolynomial(exponent, polynomial, degree):
+        """ Determines x ^ exponent mod polynomial over GF(2).
+
+        Polynomials are stored as bit masks, with bit k the coefficient of
+        x ^ k.
+
+        :param exponent:
+            The power to raise x to.
+        :type exponent:
+            int
+        :param polynomial:
+            The modulus polynomial, with a leading term of x ^ degree.
+        :type polynomial:
+            int
+        :param degree:
+            The degree of the modulus polynomial.
+        :type degree:
+            int
+
+        :returns:
+            int : The remainder polynomial as a bit mask.
+        """
+        def multiply(a, b):
+            product = 0
+            while b:
+                if b & 1:
+                    product ^= a
+                b >>= 1
+                a <<= 1
+                if (a >> degree) & 1:
+                    a ^= polynomial
+            return product
+
+        result = 1
+        base = 2
+        while exponent:
+            if exponent & 1:
+                result = multiply(result, base)
+            base = multiply(base, base)
+            exponent >>= 1
+
+        return result
     
     def _generateTagS(self, mls_signal, number_taps):
         """  Generate the permutation vector to permetate the signal for the 
@@ -261,14 +1075,13 @@ class MlsDb(object):
             array of int: The Tag S vector
         """
         self.logger.debug("Entering _generateTagS")
-        
-        length = len(mls_signal)
-        tag_s = zeros(len(mls_signal))
-        
-        for signal_index in range(len(mls_signal)):
-            for i in range(number_taps):
-                tag_s[signal_index] += mls_signal[(length + signal_index - i) % 
-                                        length] * ( 2 ** (number_taps - 1 - i))
+
+        # tag_s[j] = sum(mls[j - i] * 2 ^ (number_taps - 1 - i))
+        mls_signal = asarray(mls_signal, dtype=int32)
+        tag_s = zeros(len(mls_signal), dtype=int32)
+
+        for i in range(number_taps):
+            tag_s += roll(mls_signal, i) << (number_taps - 1 - i)
     
         return tag_s
         
@@ -293,23 +1106,24 @@ class MlsDb(object):
         self.logger.debug("Entering _generateTagR")
 
         length = len(mls_signal)
-        col_sum = zeros(length)
-        index = zeros(number_taps)
-    
-        for signal_index in range(length):
-            for i in range(number_taps):
-                col_sum[signal_index] += int(mls_signal[(length + 
-                    signal_index - i) % length]) << (number_taps - 1 - i)
-            
-            for i in range(number_taps):
-                if col_sum[signal_index] == (2 ** i):
-                    index[i] = signal_index
-    
-        tag_r = zeros(length)
-        for l_index in range(length):
-            for i in range(number_taps):
-                tag_r[l_index] += mls_signal[(length + index[i] - l_index) % 
-                                            length] * ( 1 << i)
+        mls_signal = asarray(mls_signal, dtype=int32)
+
+        # The column sums are the same as tag_s, find where each power of 2
+        # is located
+        col_sum = self._generateTagS(mls_signal, number_taps)
+        locations = zeros(length + 1, dtype=int)
+        locations[col_sum] = arange(length)
+        index = locations[1 << arange(number_taps)]
+
+        # tag_r[l] = sum(mls[index[i] - l] * 2 ^ i), and since
+        # mls[index - l] = reversed_mls[l - index], where
+        # reversed_mls[l] = mls[-l], each term is a rotation of reversed_mls
+        reversed_mls = r_[mls_signal[:1], mls_signal[:0:-1]]
+
+        tag_r = zeros(length, dtype=int32)
+        for i in range(number_taps):
+            tag_r += roll(reversed_mls, index[i]) << i
+
         return tag_r
     
     def _permutateSignal(self, signal, tag_s):
@@ -317,7 +1131,8 @@ class MlsDb(object):
             
             :param signal:
                 The response to the system that was excited by the MLS signal
-                used to generate tag_s.  Must be the same length as tag_s.
+                used to generate tag_s.  Must be the same length as tag_s.  If
+                it is a 2-D array, each row is permutated.
             :type signal:
                 array of float
             :param tag_s:
@@ -331,15 +1146,12 @@ class MlsDb(object):
                 using the Fast Hadamard Transform.
         """
         self.logger.debug("Entering _permutateSignal")
-        
-        dc = 0
-        for sample in signal:
-            dc += sample
-        permutation = zeros(len(signal) + 1)
-        permutation[0] = -dc
-
-        for sample_index in range(len(signal)):
-            permutation[tag_s[sample_index]] = signal[sample_index]
+
+        signal = asarray(signal)
+
+        permutation = zeros(signal.shape[:-1] + (signal.shape[-1] + 1, ))
+        permutation[..., 0] = -signal.sum(axis=-1)
+        permutation[..., tag_s] = signal
     
         return permutation
     
@@ -361,18 +1173,24 @@ class MlsDb(object):
         """
         self.logger.debug("Entering _permutateResponse")
     
-        scale_factor = 1 / float(len(permutation))
-        
-        response = []
-        for i in range(len(permutation) - 1):
-            response = append(response, permutation[tag_r[i]] * scale_factor)
+        scale_factor = 1 / float(permutation.shape[-1])
         
-        response = append(response, 0)
+        response = zeros(permutation.shape)
+        response[..., :-1] = permutation[..., tag_r] * scale_factor
 
         return response
         
     def _fht(self, x, number_taps):
         """ Preform the Fast Hadamard Transform on the permutated vector x.
+
+            Each of the number_taps butterfly stages is preformed on the whole
+            vector at once.  For a stage with a block size of k1, the vector
+            is viewed as an array of shape (len(x) / k1, 2, k1 / 2), so that
+            the upper and lower halves of every block line up, and the
+            butterflies are then simply the sum and difference of the two
+            halves.  The transform is done in place.
+
+            If x is a 2-D array, each row is transformed.
             
             @param x: The vector to preform the Fast Hadamard Transform on
             @param number_taps: The number of taps used to generate the orginal
@@ -381,16 +1199,25 @@ class MlsDb(object):
             @return: The transformed vector
             
         """
-    
-        k1 = len(x)
+        x = ascontiguousarray(x, dtype=float64)
+        rows = x.shape[:-1]
+        length = x.shape[-1]
+
+        # Scratch space to hold the difference of the halves, shared by all
+        # the stages
+        difference = empty(rows + (length / 2, ))
+
+        k1 = length
         for k in range(number_taps):
             k2 = k1 / 2
-            for j in range(k2):
-                for i in range(j, len(x), k1):
-                    i1 = i + k2
-                    temp = x[i] + x[i1]
-                    x[i1] = x[i] - x[i1]
-                    x[i]=temp
+            blocks = x.reshape(rows + (-1, 2, k2))
+            upper = blocks[..., 0, :]
+            lower = blocks[..., 1, :]
+            temp = difference.reshape(upper.shape)
+
+            subtract(upper, lower, temp)
+            upper += lower
+            lower[...] = temp
             k1 /= 2
     
         return x
@@ -422,3 +1249,50 @@ if __name__=="__main__":
 
     response = mls_db.getSystemResponse(mls_signal, 4)
     print response
+
+    # Benchmark the permutations, as they are a single gather / scatter the
+    # time per sample should remain roughly constant up to 18 taps.
+    import time
+    logger.setLevel(logging.INFO)
+    for number_taps in range(10, 18 + 1):
+        mls_signal = -2 * mls_db.getMls(number_taps) + 1
+        (tag_r, tag_s) = mls_db._getTags(number_taps)
+
+        start = time.time()
+        permutation = mls_db._permutateSignal(mls_signal, tag_s)
+        permutation_time = time.time() - start
+
+        start = time.time()
+        transformed_signal = mls_db._fht(permutation, number_taps)
+        fht_time = time.time() - start
+
+        start = time.time()
+        response = mls_db._permutateResponse(transformed_signal, tag_r)
+        permutation_time += time.time() - start
+
+        print "%2d taps: permutation %.2f ms (%.2f ns / sample), FHT %.2f ms" % (
+            number_taps, permutation_time * 1e3,
+            permutation_time * 1e9 / len(mls_signal), fht_time * 1e3)
+
+    # Compare the Fast Hadamard Transform and the FFT cross-correlation, both
+    # in speed and the difference between their responses.
+    for number_taps in range(10, 20 + 1):
+        mls_signal = -2 * mls_db.getMls(number_taps) + 1
+
+        # Warm up the caches of the tags and the MLS spectrum
+        mls_db.getSystemResponse(mls_signal, number_taps, method="fht")
+        mls_db.getSystemResponse(mls_signal, number_taps, method="fft")
+
+        start = time.time()
+        fht_response = mls_db.getSystemResponse(mls_signal, number_taps,
+                                                method="fht")
+        fht_time = time.time() - start
+
+        start = time.time()
+        fft_response = mls_db.getSystemResponse(mls_signal, number_taps,
+                                                method="fft")
+        fft_time = time.time() - start
+
+        print "%2d taps: FHT %.2f ms, FFT %.2f ms, max difference %.2e" % (
+            number_taps, fht_time * 1e3, fft_time * 1e3,
+            max(abs(fht_response - fft_response)))
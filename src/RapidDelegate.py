@@ -138,4 +138,5 @@ if __name__ == "__main__":
     alpha = RapidDelegate()
 
     app.exec_()
+    alpha.close()
 
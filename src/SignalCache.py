@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+""" Provides a cache of generated excitation signals.
+
+Generating, filtering and padding an excitation signal can take a noticeable
+amount of time, and consecutive measurements usually use the same settings.
+The signal cache keeps the generated signals, keyed by the settings that
+affect the signal, so the signal is only generated the first time it is used.
+Optionally, the signals are also saved to a directory, so they persist between
+sessions.
+"""
+
+from collections import OrderedDict
+import hashlib
+import logging
+import os
+import threading
+
+from numpy import float64, load, save
+
+from ExcitationPlan import ExcitationPlan
+from SignalGenerator import SignalGenerator
+
+__author__ = "Lance Jenkin"
+__email__ = "lancejenkin@gmail.com"
+
+
+class SignalCache(object):
+
+    def __init__(self, max_bytes=256 * 2 ** 20, cache_directory=None):
+        """ Constructor for SignalCache object.
+
+        :param max_bytes:
+            The maximum number of bytes of signals to keep in memory, the least
+            recently used signals are evicted first.  None for no limit.
+        :type max_bytes:
+            int
+        :param cache_directory:
+            The directory to save the signals to, so that they persist between
+            sessions.  If None, the signals are only kept in memory.
+        :type cache_directory:
+            str
+        """
+        self.logger = logging.getLogger("Alpha")
+        self.logger.debug("Creating SignalCache Object")
+
+        self.max_bytes = max_bytes
+        self.cache_directory = cache_directory
+
+        self._signals = OrderedDict()
+        self._lock = threading.RLock()
+
+        if cache_directory is not None and not os.path.exists(cache_directory):
+            os.makedirs(cache_directory)
+
+    def getSignal(self, parameters, signal_dtype=float64):
+        """ Returns the signal generated with the specified parameters,
+        generating it if it is not in the cache.
+
+        :param parameters:
+            The parameters to use to generate the signal, as given to the
+            SignalGenerator, or the excitation plan compiled from them.
+        :type parameters:
+            dict or ExcitationPlan
+        :param signal_dtype:
+            The data type of the signal.  Ignored if an ExcitationPlan is
+            given.
+        :type signal_dtype:
+            numpy dtype
+
+        :returns:
+            array of float : The signal, which is shared and therefore read
+            only.
+        """
+        self.logger.debug("Entering getSignal")
+
+        if not isinstance(parameters, ExcitationPlan):
+            parameters = ExcitationPlan(parameters, signal_dtype)
+
+        key = self.signalKey(parameters)
+
+        with self._lock:
+            signal = self._signals.pop(key, None)
+
+            if signal is None:
+                signal = self._loadSignal(key)
+
+            if signal is None:
+                self.logger.debug("Generating signal %s" % (key))
+                signal_gen = SignalGenerator(parameters)
+                signal = signal_gen.signal
+                self._saveSignal(key, signal)
+
+            signal.flags.writeable = False
+
+            # Insert as the most recently used signal
+            self._signals[key] = signal
+            self._evict()
+
+        return signal
+
+    def clear(self):
+        """ Removes all the signals held in memory. """
+        self.logger.debug("Entering clear")
+
+        with self._lock:
+            self._signals.clear()
+
+    def signalKey(self, parameters, signal_dtype=float64):
+        """ Determines the key of the signal generated with the parameters.
+
+        Only the parameters that affect the signal are used, and they are
+        parsed by the excitation plan, so that for instance "14" and 14 taps
+        give the same key.
+
+        :param parameters:
+            The parameters to use to generate the signal, or the excitation
+            plan compiled from them.
+        :type parameters:
+            dict or ExcitationPlan
+        :param signal_dtype:
+            The data type of the signal.  Ignored if an ExcitationPlan is
+            given.
+        :type signal_dtype:
+            numpy dtype
+
+        :returns:
+            str : A hex digest identifying the signal.
+        """
+        if not isinstance(parameters, ExcitationPlan):
+            parameters = ExcitationPlan(parameters, signal_dtype)
+
+        key = hashlib.sha1(repr(parameters.signal_key))
+
+        # The compensation filter changes with the contents of the loudspeaker
+        # measurement, not just its filename
+        if parameters.compensation_filter is not None:
+            # Imported here, as the compensation filter imports the analysis
+            from CompensationFilter import CompensationFilter
+
+            compensation_filter = CompensationFilter()
+            key.update(compensation_filter.filterKey(
+                parameters.compensation_filter))
+
+        return key.hexdigest()
+
+    def _evict(self):
+        """ Evicts the least recently used signals until the cache is within
+        its limit.  The most recently used signal is always kept.
+        """
+        if self.max_bytes is None:
+            return
+
+        cache_bytes = sum(signal.nbytes for signal in self._signals.values())
+        while len(self._signals) > 1 and cache_bytes > self.max_bytes:
+            (key, signal) = self._signals.popitem(last=False)
+            cache_bytes -= signal.nbytes
+
+    def _signalFilename(self, key):
+        """ Returns the filename the signal with the key is saved to. """
+        return os.path.join(self.cache_directory, "%s.npy" % (key))
+
+    def _loadSignal(self, key):
+        """ Loads the signal with the key from the cache directory.
+
+        :param key:
+            The key of the signal.
+        :type key:
+            str
+
+        :returns:
+            array of float : The signal, or None if it has not been saved.
+        """
+        if self.cache_directory is None:
+            return None
+
+        signal_filename = self._signalFilename(key)
+        if not os.path.exists(signal_filename):
+            return None
+
+        self.logger.debug("Loading signal %s" % (key))
+        try:
+            return load(signal_filename)
+        except (IOError, ValueError) as error:
+            self.logger.error("Could not load %s: %s" % (signal_filename,
+                                                         error))
+            return None
+
+    def _saveSignal(self, key, signal):
+        """ Saves the signal to the cache directory, if there is one.
+
+        :param key:
+            The key of the signal.
+        :type key:
+            str
+        :param signal:
+            The signal to save.
+        :type signal:
+            array of float
+        """
+        if self.cache_directory is None:
+            return
+
+        signal_filename = self._signalFilename(key)
+        try:
+            save(signal_filename, signal)
+        except IOError as error:
+            self.logger.error("Could not save %s: %s" % (signal_filename,
+                                                         error))
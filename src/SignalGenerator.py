@@ -4,16 +4,21 @@
 Cepstral analysis requires signals that have flat spectra.  This signal
 generate is used to generate two different signals containing flat spectra,
 namely Swept Sine and Maximum Length Sequence (MLS).  There is also an option
-to modified the Swept Sine signal to remove the ripples in the spectrum.
+to modified the Swept Sine signal to remove the ripples in the spectrum, and an
+exponential swept sine, which is deconvolved with an analytic inverse filter.
 
 MLS signals are precalculated, and retrieved from a database using a seperate
 interface.
 """
 from pylab import *
-from scipy.signal import butter, lfilter, filtfilt, iirdesign, firwin
+from scipy.signal import butter, lfilter, filtfilt, iirdesign, firwin, sosfilt
 from scipy.fftpack import rfft, rfftfreq
+from collections import OrderedDict
 import logging
+import numpy.fft
+import threading
 
+from ExcitationPlan import ExcitationPlan
 from MlsDb import MlsDb
 
 __author__ = "Lance Jenkin"
@@ -21,20 +26,48 @@ __email__ = "lancejenkin@gmail.com"
 
 
 class SignalGenerator(object):
-
-    def __init__(self, parameters):
+    # Designed sweeps and the exponential sweep inverse filter spectra, shared
+    # between the generator and the analysis of the measurement
+    _sweep_cache = OrderedDict()
+    _sweep_cache_lock = threading.RLock()
+    _SWEEP_CACHE_SIZE = 8
+    # Second order sections of the excitation filters
+    _filter_cache = {}
+    _filter_cache_lock = threading.RLock()
+
+    def __init__(self, parameters, dtype=float64, streaming=False):
         """Constructor to create signal generator
 
         :param parameters:
-            The parameters to use to generate the signal.  It is a dictionary
-            containing information, such as sample rate, signal type and other
-            depending on the signal.
+            The parameters to use to generate the signal.  It is either a
+            dictionary containing information, such as sample rate, signal type
+            and other depending on the signal, or an ExcitationPlan already
+            compiled from the dictionary.
         :type parameters:
-            dict
+            dict or ExcitationPlan
+        :param dtype:
+            The data type of the generated signal, float32 halves the memory
+            used by long signals.  Ignored if an ExcitationPlan is given.
+        :type dtype:
+            numpy dtype
+        :param streaming:
+            If True, the repeated signal is not assembled, and the signal
+            property is None.  The signal is instead retrieved in blocks
+            using generateBlocks.  The repetitions of MLS and IRS signals
+            are then also generated as the blocks are, unless a compensation
+            filter is used.
+        :type streaming:
+            bool
         """
         self.logger = logging.getLogger("Alpha")
 
         self.parameters = parameters
+        if isinstance(parameters, ExcitationPlan):
+            self.plan = parameters
+        else:
+            self.plan = ExcitationPlan(parameters, dtype)
+        self.dtype = self.plan.dtype
+        self.streaming = streaming
 
         self.mls_db = MlsDb()
 
@@ -51,6 +84,7 @@ class SignalGenerator(object):
         self.logger.debug("Entering setParameters")
 
         self.parameters = parameters
+        self.plan = ExcitationPlan(parameters, self.dtype)
         self.generateSignal()
 
     def generateSignal(self):
@@ -62,144 +96,71 @@ class SignalGenerator(object):
         """
         self.logger.debug("Entering generateSignal")
 
-        # Get parameters
-        signal_type = str(self.parameters["signal type"])
-
-        lpf_enabled = int(self.parameters["lpf enabled"])
-        lpf_cutoff = int(self.parameters["lpf cutoff"])
-        lpf_order = int(self.parameters["lpf order"])
-        hpf_enabled = int(self.parameters["hpf enabled"])
-        hpf_cutoff = int(self.parameters["hpf cutoff"])
-        hpf_order = int(self.parameters["hpf order"])
+        signal_type = self.plan.signal_type
 
-        pad_signal = int(self.parameters["pad signal"])
-        signal_reps = int(self.parameters["signal reps"])
+        # The period of a sequence whose repetitions are generated lazily
+        self.sequence = None
 
-        if "gain" in self.parameters:
-            gain = float(self.parameters["gain"])
-            if gain <= 0:
-                # Gain is in dB; convert to decimal
-                gain = 10 ** (gain / 20.0)
-        else:
-            gain = 0.562341325190349 # -6 dB
         # Generate the signal
-        if signal_type.lower() == "swept sine":
+        if signal_type == "swept sine":
             self.generateSweptSine()
-        if signal_type.lower() == "low pass swept sine":
+        if signal_type == "low pass swept sine":
             self.generateLowPassSweptSine()
-        if signal_type.lower() == "maximum length sequence":
+        if signal_type == "exponential swept sine":
+            self.generateExponentialSweptSine()
+        if signal_type == "maximum length sequence":
             self.generateMls()
-        if signal_type.lower() == "inverse repeat sequence":
+        if signal_type == "inverse repeat sequence":
             self.generateIRS()
 
-        # Filter the signal
-        if lpf_enabled == 1:
-            self.filterSignal(lpf_cutoff, lpf_order, "low")
-        if hpf_enabled == 1:
-            self.filterSignal(hpf_cutoff, hpf_order, "high")
-
-
-        #self.inverseFilter()
-        # Adjust gain
-        # TODO: Get gain from database
-        self.signal /= max(abs(self.signal))
-        self.signal *= gain
-
-        # Pad the filter with impulse, and delay at the end
-        if pad_signal == 1:
-            self.padSignal()
-
-        # Repeat the signal to improve SNR
-        tmp_signal = self.signal
-        for i in range(signal_reps):
-            self.signal = r_[self.signal, tmp_signal]
-
-    def inverseFilter(self):
-        """
-            Loads the frequency response of the loud speaker,
-            fits a cosine series to the logarithm of squared magnitude of the frequency response.
-            determines the magnitude of the spectrum by
-                |Sf| = |St| / |Sl|
-            with:
-                Sf the frequency repsonse of the consentation filter
-                St is the target spectrum
-                Sl is the loudspeaker response
-
-            determines the minimum phase of the compensation filter:
+        if self.sequence is not None:
+            # The repetitions are filtered as they are generated, so the
+            # gain is found from a first pass over them
+            peak = max(abs(samples).max() for samples in
+                       self.generateSequence())
+            self.sequence_scale = self.plan.gain / peak
+        else:
+            # Filter the signal, a band pass filter is a low pass filter
+            # followed by a high pass filter
+            if self.plan.filters:
+                self.filterSignal(self.plan.filters)
+
+            # Compensate for the loudspeaker's response
+            if self.plan.compensation_filter is not None:
+                self.inverseFilter(self.plan.compensation_filter)
+
+            # Adjust gain
+            # TODO: Get gain from database
+            self.signal /= max(abs(self.signal))
+            self.signal *= self.plan.gain
+
+        # Pad the signal with an impulse and delays, and repeat the signal to
+        # improve SNR
+        self.assembleSignal()
+
+    def inverseFilter(self, measurement_filename):
+        """ Filters the signal with the compensation filter of the loudspeaker,
+            so that the spectrum of the signal played by the loudspeaker is
+            flat.
+
+            The compensation filter is built from the loudspeaker's frequency
+            response measurement the first time it is used, and saved for
+            later signals.  See CompensationFilter for the details.
+
+        :param measurement_filename:
+            The filename of the loudspeaker frequency response measurement.
+        :type measurement_filename:
+            str
         """
         self.logger.debug("Entering inverseFilter")
-        import BaseDelegate
-        # Create new base delegate
-        bd = BaseDelegate.BaseDelegate()
-
-        # Load the frequency response
-        measurement_file = "../testdata/120802_frequency_response_20.fdb"
-
-        freq_response = bd.loadFrequencyResponse(measurement_file)
-        sample_rate = float(freq_response.measurement_settings["sample rate"])
-
-        N = len(freq_response.frequency_response)
-        # find the bin of 4000 Hz
-        bin = float(floor(4410* N / sample_rate))
-        freq = freq_response.frequency_response
-
-        # We are solving Ax = 2 * log10(abs(y))
-        # Determine A
-        M = 20
-        k = arange(bin)
-
-        a = array([])
-        for m in range(M):
-            a = r_[a, cos(2 * pi * k * m / bin)]
-        A = matrix(reshape(a, (M, bin)))
-
-        # Determine the weights
-        W = pinv(A).transpose()*asmatrix(2 * log10(abs(freq[:bin]))).transpose()
-
-        # Create 2 * log10(abs(y))
-        s = zeros(bin)
-        for m, w in enumerate(W):
-            s += w[0,0] * cos(2 * pi * k * m / bin)
-
-        # target spectrum is now
-        mix_samples = ceil(bin * 0.1)
-        # create first half of s
-        transistion = linspace(1, 0, mix_samples) * s[-mix_samples:] + linspace(0, 1, mix_samples) * 2 * log10(freq_response.frequency_response[bin - mix_samples: bin])
-        s = r_[s[:bin - mix_samples], transistion, 2 * log10(freq_response.frequency_response[bin:N / 2])]
-
-        # mirror it
-        s = r_[s, s[::-1]]
-
-        plot(s)
-        plot(2*log10(freq_response.frequency_response))
-        show()
-
-        S = 10 ** (s / 2.0)
-        #plot(S,  "--")
-        #plot(freq_response.frequency_response)
-        #show()
-        # compensation filter
-        X = fft(self.signal, N)
-        Sc = abs(freq_response.frequency_response) / abs(X)
-
-        #Sc = abs(S) / abs(freq_response.frequency_response)
-
-        # To ensure that the filter is causal, and the impulse response is as short as possible in the time domain
-        # determine the minimum phase to use with the filter
-        c = ifft(log(abs(Sc) ** -1), N)
-        m = r_[c[0], 2 * c[1:N / 2.0 - 1], c[N/2] ]
-        m = r_[m, zeros(N - len(m))]
-
-        Scmp = exp(fft(m, N))
-
-        Y = Scmp * X
-        x = ifft(Y)
-
-        x = x[:len(self.signal)]
-
-        self.signal = x / max(abs(x))
+        # Imported here, as the analysis imports the signal generator
+        from CompensationFilter import CompensationFilter
 
+        compensation_filter = CompensationFilter()
+        impulse_response = compensation_filter.getFilter(measurement_filename)
 
+        self.signal = compensation_filter.applyFilter(self.signal,
+                                                      impulse_response)
 
     def generateSweptSine(self):
         """Generate a linear swept sine wave from lower frequency to an upper
@@ -219,14 +180,11 @@ class SignalGenerator(object):
         self.logger.debug("Entering generateSweptSine")
 
         # Get signal parameters
-        if "lower frequency" in self.parameters:
-            f_0 = int(self.parameters["lower frequency"])
-        else:
-            f_0 = 0
-        f_1 = int(self.parameters["upper frequency"])
-        T = float(self.parameters["signal length"])
-        sample_rate = float(self.parameters["sample rate"])
-        signal_length = float(self.parameters["signal length"])
+        f_0 = self.plan.lower_frequency
+        f_1 = self.plan.upper_frequency
+        T = self.plan.sweep_length
+        sample_rate = self.plan.sample_rate
+        signal_length = self.plan.sweep_length
 
         # Generate time
         t = arange(0, signal_length, 1 / sample_rate)
@@ -282,57 +240,287 @@ class SignalGenerator(object):
         self.logger.debug("Entering generateModifiedSweptSine")
 
         # Get signal parameters
-        f_0 = int(self.parameters["lower frequency"])
-        f_1 = int(self.parameters["upper frequency"])
-        T = float(self.parameters["signal length"])
-        sample_rate = float(self.parameters["sample rate"])
-        fft_size = int(self.parameters["fft size"])
-        signal_length = float(self.parameters["signal length"])
-
-        # Generate time vector
-        t = arange(0, signal_length, 1 / sample_rate)
+        sample_rate = self.plan.sample_rate
+        fft_size = self.plan.fft_size
+        signal_length = self.plan.sweep_length
+
+        smp = self.getLowPassSweep(signal_length, sample_rate, fft_size)
+
+        # The cached sweep is shared, so filter and scale a copy
+        self.signal = smp.copy()
+
+    @classmethod
+    def getLowPassSweep(cls, signal_length, sample_rate, fft_size):
+        """ Returns the minimum phase swept sine, designing it if it has not
+            been designed yet.
+
+            The design only depends on the signal length, sample rate and FFT
+            size.  The spectra are those of real signals, so real FFTs of
+            fft_size points are used.
+
+        :param signal_length:
+            The length of the sweep in seconds.
+        :type signal_length:
+            float
+        :param sample_rate:
+            The sample rate of the sweep.
+        :type sample_rate:
+            float
+        :param fft_size:
+            The number of points used to design the inverse filter.
+        :type fft_size:
+            int
+
+        :returns:
+            array of float : The sweep, which is shared and therefore read
+            only.
+        """
+        def designSweep():
+            T = signal_length
+
+            # Generate time vector
+            t = arange(0, signal_length, 1 / sample_rate)
+
+            # Generate the signal from 0 to Nyquist frequency
+            s = sin(2 * pi * (((sample_rate / 2)   - 0) / (2 * T) * t + 0) * t)
+
+            # Determine the spectrum
+            S = numpy.fft.rfft(s, fft_size)
+
+            # Inverse of the magnitude spectrum
+            iaS = abs(S) ** -1
+
+            # c, similar to the cepstrum, is the inverse of the logarithmic
+            # inverse magnitude spectrum
+            c = numpy.fft.irfft(log(iaS), fft_size)
+
+            # Window c to produce m
+            m = r_[c[0], 2 * c[1:fft_size / 2 - 1], c[fft_size / 2],
+                   zeros(fft_size / 2)]
+
+            # Determine the spectrum of the windowed 'cepstrum'
+            M = numpy.fft.rfft(m, fft_size)
+
+            # Determine the minimum phase inverse filter
+            iSmp = exp(M)
+
+            # Determine the minimum phase spectrum
+            Smp = S * iSmp
+
+            # Determin the minimum phase signal
+            smp = numpy.fft.irfft(Smp, fft_size)
+
+            # smp will have fft_size samples, which could be very long
+            # reduce to length of the signal specified
+            smp = smp[:len(t)]
+
+            # Normalize so that the maximum value is 1
+            smp /= max(abs(smp))
+
+            return smp
+
+        key = ("low pass", signal_length, sample_rate, fft_size)
+        return cls._getCachedSweep(key, designSweep)
+
+    def generateExponentialSweptSine(self):
+        """Generate an exponential swept sine from the lower frequency to the
+           upper frequency, in a specific length of time.
+
+           The exponential swept sine spends the same time in each octave, so
+           it has a pink spectrum.  It is deconvolved with an inverse filter,
+           rather than by dividing spectra, which separates the harmonic
+           distortion from the linear response.  The parameters for the swept
+           sine are stored in the parameters dictionary.
+        """
+        self.logger.debug("Entering generateExponentialSweptSine")
+
+        # Get signal parameters
+        f_0 = self.plan.lower_frequency
+        f_1 = self.plan.upper_frequency
+        signal_length = self.plan.sweep_length
+        sample_rate = self.plan.sample_rate
+
+        sweep = self.getExponentialSweep(f_0, f_1, signal_length, sample_rate)
+
+        # The cached sweep is shared, so filter and scale a copy
+        self.signal = sweep.copy()
+
+    @classmethod
+    def getExponentialSweep(cls, f_0, f_1, signal_length, sample_rate):
+        """ Returns the exponential swept sine, generating it if it has not
+            been generated yet.
+
+            The exponential swept sine is given by
+                s = sin(2 * pi * f_0 * T / R * (e ^ (t * R / T) - 1))
+            where:
+                R = ln(f_1 / f_0)
+                T is the signal length
+                f_1, f_0 are the upper and lower frequencies
+
+        :param f_0:
+            The lower frequency of the sweep, must be greater than 0.
+        :type f_0:
+            float
+        :param f_1:
+            The upper frequency of the sweep.
+        :type f_1:
+            float
+        :param signal_length:
+            The length of the sweep in seconds.
+        :type signal_length:
+            float
+        :param sample_rate:
+            The sample rate of the sweep.
+        :type sample_rate:
+            float
 
-        # Generate the signal from 0 to Nyquist frequency
-        s = sin(2 * pi * (((sample_rate / 2)   - 0) / (2 * T) * t + 0) * t)
+        :returns:
+            array of float : The sweep, which is shared and therefore read
+            only.
+        """
+        if f_0 <= 0 or f_1 <= f_0:
+            raise Exception("Exponential sweep requires 0 < lower frequency "
+                            "< upper frequency, got %s and %s" % (f_0, f_1))
+
+        def generateSweep():
+            t = arange(int(signal_length * sample_rate)) / sample_rate
+            rate = log(f_1 / f_0)
+
+            return sin(2 * pi * f_0 * signal_length / rate *
+                       (exp(t * rate / signal_length) - 1))
+
+        key = ("sweep", f_0, f_1, signal_length, sample_rate)
+        return cls._getCachedSweep(key, generateSweep)
+
+    @classmethod
+    def getInverseSweepSpectrum(cls, f_0, f_1, signal_length, sample_rate,
+                                fft_size):
+        """ Returns the spectrum of the inverse filter of the exponential swept
+            sine, for use with rfft of fft_size points.
+
+            The inverse filter is the time reversed sweep, with an envelope
+            rising 6 dB per octave of the sweep's frequency, to compensate for
+            the pink spectrum of the sweep.  It is normalized to unity gain at the centre frequency of
+            the sweep.  Convolving the response to the sweep with the inverse
+            filter places the linear impulse response at len(sweep) - 1, with
+            the harmonic distortion products before it.
+
+        :param f_0:
+            The lower frequency of the sweep.
+        :type f_0:
+            float
+        :param f_1:
+            The upper frequency of the sweep.
+        :type f_1:
+            float
+        :param signal_length:
+            The length of the sweep in seconds.
+        :type signal_length:
+            float
+        :param sample_rate:
+            The sample rate of the sweep.
+        :type sample_rate:
+            float
+        :param fft_size:
+            The size of the FFT the spectrum is used with.
+        :type fft_size:
+            int
 
+        :returns:
+            array of complex : The spectrum, which is shared and therefore read
+            only.
+        """
+        sweep = cls.getExponentialSweep(f_0, f_1, signal_length, sample_rate)
 
-        # Determine the spectrum
-        S = fft(s, fft_size)
+        def generateSpectrum():
+            t = arange(len(sweep)) / sample_rate
+            rate = log(f_1 / f_0)
 
-        # Inverse of the magnitude spectrum
-        iaS = abs(S) ** -1
+            inverse_filter = sweep[::-1] * exp(t[::-1] * rate / signal_length)
 
-        # c, similar to the cepstrum, is the inverse of the logarithmic inverse
-        # magnitude spectrum
-        c = ifft(log(iaS))
+            spectrum = numpy.fft.rfft(inverse_filter, fft_size)
 
-        # Window c to produce m
-        m = r_[c[0], 2 * c[1:len(S) / 2 - 1], c[len(S) / 2], zeros(len(S) / 2)]
+            # Normalize to unity gain at the centre frequency
+            centre_bin = int(round(sqrt(f_0 * f_1) * fft_size / sample_rate))
+            gain = abs(numpy.fft.rfft(sweep, fft_size)[centre_bin] *
+                       spectrum[centre_bin])
 
-        # Determine the spectrum of the windowed 'cepstrum'
-        M = fft(m, fft_size)
+            return spectrum / gain
 
-        # Determine the minimum phase inverse filter
-        iSmp = exp(M)
+        key = ("inverse", f_0, f_1, signal_length, sample_rate, fft_size)
+        return cls._getCachedSweep(key, generateSpectrum)
 
-        # Determine the minimum phase spectrum
-        Smp = S * iSmp
+    @classmethod
+    def deconvolveSweep(cls, responses, plan):
+        """ Deconvolve the responses to an exponential swept sine with the
+            inverse filter of the sweep, by FFT convolution.
 
-        # Determin the minimum phase signal
-        smp = ifft(Smp)
+            The harmonic distortion products precede the linear impulse
+            response, and are discarded.  The responses are cut at their own
+            impulse locations, so they may differ in length, and are trimmed
+            to the shortest response.
 
-        # smp will have fft_size samples, which could be very long
-        # reduce to length of the signal specified
-        smp = smp[:len(t)]
+        :param responses:
+            The averaged responses to the sweep.
+        :type responses:
+            list of array of float
+        :param plan:
+            The excitation plan of the sweep.
+        :type plan:
+            ExcitationPlan
 
-         # Low pass filter the signal to the upper frequency
-        [b, a] = butter(8, 0.8 * f_1 / (sample_rate / 2), btype="low")
-        #smp = lfilter(b, a, smp)
+        :returns:
+            array of float : The linear impulse responses, one per row.
+        """
+        response_length = min(len(response) for response in responses)
+        responses = array([response[:response_length]
+                           for response in responses])
+        sweep_length = plan.burst_length
+
+        # Linear convolution, padded to a power of 2
+        fft_size = 2 ** int(ceil(log2(response_length + sweep_length - 1)))
+        inverse_spectrum = cls.getInverseSweepSpectrum(plan.lower_frequency,
+                                                       plan.upper_frequency,
+                                                       plan.sweep_length,
+                                                       plan.sample_rate,
+                                                       fft_size)
+
+        impulse_responses = numpy.fft.irfft(
+            numpy.fft.rfft(responses, fft_size) * inverse_spectrum, fft_size)
+
+        # The linear impulse response starts at the end of the inverse filter
+        return impulse_responses[:, sweep_length - 1:
+                                    sweep_length - 1 + response_length]
+
+    @classmethod
+    def _getCachedSweep(cls, key, generator):
+        """ Returns the cached array with the key, calling generator to create
+            it if it is not cached.  Only the most recently used arrays are
+            kept.
+
+        :param key:
+            The key of the array.
+        :type key:
+            tuple
+        :param generator:
+            A function returning the array.
+        :type generator:
+            function
+
+        :returns:
+            array : The cached array, which is read only.
+        """
+        with cls._sweep_cache_lock:
+            value = cls._sweep_cache.pop(key, None)
+            if value is None:
+                value = generator()
+                value.flags.writeable = False
 
-        # Normalize so that the maximum value is 1
-        smp /= max(abs(smp))
+            cls._sweep_cache[key] = value
+            while len(cls._sweep_cache) > cls._SWEEP_CACHE_SIZE:
+                cls._sweep_cache.popitem(last=False)
 
-        self.signal = smp
+        return value
 
     def generateMls(self):
         """Fetches the MLS signal from the database with the desired number of
@@ -342,19 +530,14 @@ class SignalGenerator(object):
         self.logger.debug("Entering generateMls")
 
         # Get signal parameters
-        taps = int(self.parameters["mls taps"])
-        reps = int(self.parameters["mls reps"])
+        taps = self.plan.mls_taps
+        reps = self.plan.mls_reps
 
         mls = self.mls_db.getMls(taps)
 
-        mls = -2 * mls + 1
-
-        repeated_mls = mls
+        mls = -2.0 * mls + 1
 
-        for i in range(reps + 1):
-            repeated_mls = r_[repeated_mls, mls]
-
-        self.signal = repeated_mls
+        self.setSequence(mls, reps + 2)
 
     def generateIRS(self):
         """ Creates Inverse Repeat Sequence by fetching the required number of
@@ -365,78 +548,261 @@ class SignalGenerator(object):
         self.logger.debug("Entering generateIRS")
 
         # Get signal parameters
-        taps = int(self.parameters["mls taps"])
-        reps = int(self.parameters["mls reps"])
+        taps = self.plan.mls_taps
+        reps = self.plan.mls_reps
 
-        mls = self.mls_db.getMls(taps)
+        irs = self.mls_db.getIrs(taps)
+
+        self.setSequence(irs, reps + 2)
+
+    def setSequence(self, sequence, repetitions):
+        """ Sets the signal to the repetitions of a sequence.
 
-        mls = -2 * mls + 1
+            When streaming, and no compensation filter is used, only the one
+            period of the sequence is kept, and the repetitions are generated
+            by generateSequence as the blocks are generated.  Otherwise the
+            repetitions are tiled into the signal.
 
-        irs = array([])
-        for index, sample in enumerate(r_[mls, mls]):
-            if index % 2 == 0:
-                irs = r_[irs, sample]
-            else:
-                irs = r_[irs, -1 * sample]
+        :param sequence:
+            One period of the sequence.
+        :type sequence:
+            array of float
+        :param repetitions:
+            The number of times the sequence is repeated.
+        :type repetitions:
+            int
+        """
+        if self.streaming and self.plan.compensation_filter is None:
+            self.sequence = sequence
+            self.sequence_repetitions = repetitions
+            self.sequence_scale = 1.0
+            self.signal = None
+        else:
+            self.signal = tile(sequence, repetitions)
+
+    def generateSequence(self):
+        """ Generates the repetitions of the lazily generated sequence, one
+            period at a time.  The periods are filtered with the plan's
+            filters, keeping the filter state between them, and scaled to the
+            gain.
+
+        :returns:
+            generator : Yields each period of the sequence, as an array of
+            float.
+        """
+        sections = None
+        if self.plan.filters:
+            sections = self.getCascadedSections(self.plan.filters)
+            state = zeros((len(sections), 2))
+
+        for repetition in range(self.sequence_repetitions):
+            samples = self.sequence
+            if sections is not None:
+                (samples, state) = sosfilt(sections, samples, zi=state)
+
+            yield samples * self.sequence_scale
+
+    def filterSignal(self, filters):
+        """ Filters the current signal with the specified filters.
+
+        The second order sections of the filters are cascaded, and the signal
+        is filtered in a single pass.
+
+        :param filters:
+            The filters to use, as (type, cutoff, order) tuples, where the type
+            is either "low" or "high", for low pass filter, or high pass
+            filter.
+        :type filters:
+            list of tuple
+        """
+        self.logger.debug("Entering filterSignal (%s)" % (filters,))
+
+        sections = self.getCascadedSections(filters)
 
-        repeated_irs = irs
-        for i in range(reps + 1):
-            repeated_irs = r_[repeated_irs, irs]
+        self.signal = sosfilt(sections, self.signal)
 
-        self.signal = repeated_irs
+    def getCascadedSections(self, filters):
+        """ Returns the second order sections of the filters, cascaded into a
+            single filter.
 
-    def filterSignal(self, cutoff, order, type):
-        """ Filters the current signal with a specified filter.
+        :param filters:
+            The filters to use, as (type, cutoff, order) tuples.
+        :type filters:
+            list of tuple
 
+        :returns:
+            array of float : The second order sections of all the filters.
+        """
+        # Get signal parameters
+        sample_rate = self.plan.sample_rate
+
+        sections = [self.getFilterSections(type, cutoff, order, sample_rate)
+                    for (type, cutoff, order) in filters]
+
+        return vstack(sections)
+
+    @classmethod
+    def getFilterSections(cls, type, cutoff, order, sample_rate):
+        """ Returns the second order sections of a Butterworth filter,
+            designing the filter if it has not been designed yet.
+
+        :param type:
+            The type of filter, either "low" or "high".
+        :type type:
+            str
         :param cutoff:
             The cut off frequency of the filter.
         :type cutoff:
             float
         :param order:
-            The order of the filter to use.
+            The order of the filter.
         :type order:
             int
-        :param type:
-            The type of filter to use, either "low" or "high", for low pass
-            filter, or high pass filter.
-        :type type:
-            str
+        :param sample_rate:
+            The sample rate of the signal to filter.
+        :type sample_rate:
+            float
+
+        :returns:
+            array of float : The second order sections, which are shared and
+            therefore read only.
         """
-        self.logger.debug("Entering filterSignal (%s, %s, %s)" % (cutoff, order, type))
+        key = (type, float(cutoff), int(order), float(sample_rate))
+
+        with cls._filter_cache_lock:
+            if key not in cls._filter_cache:
+                sections = butter(int(order), cutoff / (sample_rate / 2),
+                                  btype=type, output="sos")
+                sections.flags.writeable = False
+                cls._filter_cache[key] = sections
+
+            return cls._filter_cache[key]
+
+    def assembleSignal(self):
+        """ Assembles the final signal, optionally padding the signal with an
+            impulse at the front of the signal, followed by a delay, and a
+            delay at the end of the signal.  The padded signal is then repeated
+            signal_reps + 1 times.
+
+            The padded signal is kept as the period property.  Unless the
+            generator is streaming, the final signal is assembled into a single
+            buffer of the generator's dtype, with one row per repetition.  The
+            layout of the signal is given by the excitation plan.
+
+            If the repetitions of a sequence are generated lazily, there is no
+            padded signal, and the period property is None.
+        """
+        self.logger.debug("Entering assembleSignal")
 
-        # Get signal parameters
-        sample_rate = float(self.parameters["sample rate"])
+        plan = self.plan
 
-        if type == "high":
-            [b, a] = butter(order, cutoff / (sample_rate / 2), btype=type)
-            self.signal = lfilter(b, a, self.signal)
-        #    b = firwin(251, cutoff=[50, 200], nyq=(sample_rate / 2))
-        #    a = 1
-        #    self.signal = lfilter(b, a, self.signal)
+        if self.sequence is not None:
+            burst_length = len(self.sequence) * self.sequence_repetitions
+        else:
+            burst_length = len(self.signal)
+
+        if burst_length != plan.burst_length:
+            raise Exception("Signal has %s samples, the plan expects %s" %
+                            (burst_length, plan.burst_length))
+
+        self.period_count = plan.period_count
+
+        if self.sequence is not None:
+            self.period = None
+            return
 
-        #    [b, a] = iirdesign(wp=cutoff / (sample_rate / 2), ws = 50 / (sample_rate / 2), gpass=1, gstop=12, ftype="butter")
+        self.period = zeros(plan.period_length, dtype=self.dtype)
+
+        if plan.pad_signal:
+            self.period[plan.impulse_index] = 1
+        self.period[plan.signal_start:plan.signal_end] = self.signal
+
+        if self.streaming:
+            self.signal = None
         else:
+            bursts = empty((plan.period_count, plan.period_length),
+                           dtype=self.dtype)
+            bursts[:] = self.period
 
-            [b, a] = butter(order, cutoff / (sample_rate / 2), btype=type)
+            self.signal = bursts.reshape(-1)
 
-            self.signal = lfilter(b, a, self.signal)
+    def getSignalLength(self):
+        """ Returns the number of samples in the final signal, including the
+            padding and all the repetitions, whether or not it is streamed.
 
-    def padSignal(self):
-        """ Pad signal with an impulse at the front of the signal, followed by
-            a delay, also adds a delay to the end of the signal.
+        :returns:
+            int : The length of the signal.
         """
-        self.logger.debug("Entering padSignal")
+        return self.plan.signal_length
 
-        # Get signal parameters
-        impulse_delay = float(self.parameters["impulse delay"])
-        signal_padding = float(self.parameters["signal padding"])
-        sample_rate = float(self.parameters["sample rate"])
+    def generateBlocks(self, block_size=4096, dtype=float32):
+        """ Generates the final signal in blocks of a fixed size, without
+            holding the whole signal in memory.
+
+            The last block is padded with zeros.
+
+        :param block_size:
+            The number of samples in each block.
+        :type block_size:
+            int
+        :param dtype:
+            The data type of the blocks.
+        :type dtype:
+            numpy dtype
+
+        :returns:
+            generator : Yields each block, an array of block_size samples.
+        """
+        self.logger.debug("Entering generateBlocks")
+
+        block = zeros(block_size, dtype=dtype)
+        block_index = 0
+
+        for samples in self._generatePieces():
+            sample_index = 0
+            while sample_index < len(samples):
+                # Copy as much as possible of the current piece
+                count = min(block_size - block_index,
+                            len(samples) - sample_index)
+
+                block[block_index:block_index + count] = \
+                    samples[sample_index:sample_index + count]
+
+                block_index += count
+                sample_index += count
+
+                if block_index == block_size:
+                    yield block
+                    block = zeros(block_size, dtype=dtype)
+                    block_index = 0
+
+        if block_index > 0:
+            yield block
+
+    def _generatePieces(self):
+        """ Generates the final signal as consecutive pieces of any length.
+
+        :returns:
+            generator : Yields each piece, an array of float.
+        """
+        plan = self.plan
+
+        for period in range(plan.period_count):
+            if self.sequence is None:
+                yield self.period
+                continue
+
+            # The impulse and delay, the repetitions of the sequence, then
+            # the padding
+            start = zeros(plan.signal_start, dtype=self.dtype)
+            if plan.pad_signal:
+                start[plan.impulse_index] = 1
+            yield start
 
-        impulse_delay_samples = zeros(int(impulse_delay * sample_rate))
-        signal_padding_samples = zeros(int(signal_padding * sample_rate))
+            for samples in self.generateSequence():
+                yield samples
 
-        self.signal = r_[0, 1, impulse_delay_samples, self.signal,
-                         signal_padding_samples]
+            yield zeros(plan.period_length - plan.signal_end, dtype=self.dtype)
 
 if __name__ == "__main__":
     """ A simple example showing the use of the Signal Generator """
@@ -0,0 +1,526 @@
+#!/usr/bin/env python
+""" Provides a simulated audio backend, to playback and record without a sound
+    card.
+
+The simulated backend provides the part of the PortAudio API used by AudioIO,
+so it can be given to AudioIO in place of the PortAudio library.  It has a
+single loopback device, which runs the stream callback in a separate thread,
+and feeds the played signals back as the recorded response:
+    microphone = h * s + n
+    generator = s
+with:
+    s the signal played through the left channel, delayed by the latency
+    h the impulse response of the simulated system, such as a tube
+    n noise
+
+As with a sound card, the response to a buffer played in one callback is
+recorded in the next callback.  Unless the stream is run in real time, the
+callbacks run as fast as they can, so the throughput of the measurement can be
+benchmarked.
+"""
+
+import logging
+import threading
+import time
+
+from numpy import arange, exp, log, pi, r_, sin, zeros
+from numpy.random import RandomState
+from ctypes import CFUNCTYPE, POINTER, addressof, c_float, c_void_p, pointer
+from scipy.signal import fftconvolve
+
+from AudioIO import AudioIO, _PaDeviceInfo
+
+__author__ = "Lance Jenkin"
+__email__ = "lancejenkin@gmail.com"
+
+
+class SimulatedDevice(object):
+    # The speed of sound in air, in m/s
+    _SPEED_OF_SOUND = 343.0
+
+    def __init__(self, sample_rate=44100, impulse_response=None, latency=0.0,
+                 noise_level=0.0, seed=None):
+        """ Constructor for SimulatedDevice object.
+
+        :param sample_rate:
+            The sample rate of the device.
+        :type sample_rate:
+            An int or float, gets converted to float.
+        :param impulse_response:
+            The impulse response the microphone records the left channel
+            through.  If None, the response of a tube is used.
+        :type impulse_response:
+            array of float
+        :param latency:
+            The delay from playing to recording a sample, in s.
+        :type latency:
+            float
+        :param noise_level:
+            The standard deviation of the noise added to the microphone.
+        :type noise_level:
+            float
+        :param seed:
+            The seed of the noise, so that the noise can be repeated.
+        :type seed:
+            int
+        """
+        self.logger = logging.getLogger("Alpha")
+        self.logger.debug("Creating SimulatedDevice Object")
+
+        self.sample_rate = float(sample_rate)
+
+        if impulse_response is None:
+            impulse_response = self.tubeResponse(self.sample_rate)
+        self.impulse_response = impulse_response
+
+        self.latency_samples = int(round(latency * self.sample_rate))
+        self.noise_level = noise_level
+        self.seed = seed
+
+        self.reset()
+
+    def reset(self):
+        """ Resets the device, discarding the signal still sounding. """
+        self.logger.debug("Entering reset")
+
+        self.random = RandomState(self.seed)
+
+        # The parts of the response that are recorded in later buffers
+        self.microphone_tail = zeros(self.latency_samples +
+                                     len(self.impulse_response) - 1)
+        self.generator_tail = zeros(self.latency_samples)
+
+    def process(self, left_channel, right_channel):
+        """ Plays a buffer through the device, and returns the response
+            recorded in the same period of time.
+
+        :param left_channel:
+            The signal played through the left channel.
+        :type left_channel:
+            array of float
+        :param right_channel:
+            The signal played through the right channel, which is not
+            recorded.
+        :type right_channel:
+            array of float
+
+        :returns:
+            tuple : a two-tuple, with the microphone and the generator
+            response, the same length as the buffer.
+        """
+        frame_count = len(left_channel)
+
+        # The response to the buffer, overlapped with the previous responses
+        microphone = r_[zeros(self.latency_samples),
+                        fftconvolve(left_channel, self.impulse_response)]
+        microphone[:len(self.microphone_tail)] += self.microphone_tail
+        self.microphone_tail = microphone[frame_count:]
+        microphone = microphone[:frame_count]
+
+        if self.noise_level > 0:
+            microphone += self.noise_level * self.random.randn(frame_count)
+
+        generator = r_[self.generator_tail, left_channel]
+        self.generator_tail = generator[frame_count:]
+        generator = generator[:frame_count]
+
+        return (microphone, generator)
+
+    @staticmethod
+    def resonatorResponse(resonators, sample_rate, duration):
+        """ Determines the impulse response of a set of resonators.
+
+        Each resonator is a damped sinusoid, with the magnitude response
+            |H(f)| = a / sqrt(1 + ((f - f_0) / (B / 2)) ** 2)
+        near the resonance frequency.
+
+        :param resonators:
+            The resonators, each a tuple of the resonance frequency f_0, the
+            bandwidth B, and the amplitude a.
+        :type resonators:
+            list of tuples
+        :param sample_rate:
+            The sample rate of the response.
+        :type sample_rate:
+            float
+        :param duration:
+            The length of the response, in s.
+        :type duration:
+            float
+
+        :returns:
+            array of float : The impulse response.
+        """
+        t = arange(int(duration * sample_rate)) / float(sample_rate)
+
+        impulse_response = zeros(len(t))
+        for (f_0, B, a) in resonators:
+            impulse_response += a * exp(-pi * B * t) * sin(2 * pi * f_0 * t)
+
+        return impulse_response
+
+    @classmethod
+    def tubeResponse(cls, sample_rate, tube_length=1.0, reflection=0.8,
+                     microphone_distance=0.1, upper_frequency=6400.0,
+                     duration=0.1):
+        """ Determines the impulse response of a tube, closed by a sample at
+            the far end, as a set of resonators.
+
+        The resonances of the tube are at f_n = n c / (2 L).  The sound decays
+        by the reflection coefficient every round trip of the tube, which gives
+        each resonance a bandwidth of B = -c ln(R) / (2 pi L).
+
+        :param sample_rate:
+            The sample rate of the response.
+        :type sample_rate:
+            float
+        :param tube_length:
+            The length of the tube, L in m.
+        :type tube_length:
+            float
+        :param reflection:
+            The reflection coefficient of the sample, R.
+        :type reflection:
+            float
+        :param microphone_distance:
+            The distance from the loudspeaker to the microphone, in m.
+        :type microphone_distance:
+            float
+        :param upper_frequency:
+            The frequency of the highest resonance included, in Hz.
+        :type upper_frequency:
+            float
+        :param duration:
+            The length of the response, in s.
+        :type duration:
+            float
+
+        :returns:
+            array of float : The impulse response, with a peak of 1.
+        """
+        c = cls._SPEED_OF_SOUND
+
+        f_1 = c / (2 * tube_length)
+        bandwidth = -c * log(reflection) / (2 * pi * tube_length)
+
+        resonators = [(n * f_1, bandwidth, 1.0)
+                      for n in range(1, int(upper_frequency / f_1) + 1)]
+        impulse_response = cls.resonatorResponse(resonators, sample_rate,
+                                                 duration)
+        impulse_response /= abs(impulse_response).max()
+
+        # The sound first reaches the microphone after travelling from the
+        # loudspeaker
+        delay_samples = int(round(microphone_distance / c * sample_rate))
+
+        return r_[zeros(delay_samples), impulse_response]
+
+
+class _SimulatedFunction(object):
+
+    def __init__(self, function):
+        """ Wraps a function of the simulated backend, so that the argument
+            and return types can be set as on a PortAudio library function.
+        """
+        self.function = function
+        self.argtypes = None
+        self.restype = None
+
+    def __call__(self, *args):
+        return self.function(*args)
+
+
+class _SimulatedStream(object):
+
+    def __init__(self, sample_rate, frames_per_buffer, callback, user_data):
+        """ Constructor for a stream of the simulated backend. """
+        self.sample_rate = sample_rate
+        self.frames_per_buffer = frames_per_buffer
+        self.callback = callback
+        self.user_data = user_data
+
+        self.finished_callback = None
+        self.thread = None
+        self.stopped = threading.Event()
+
+
+class SimulatedPortAudio(object):
+    # PortAudio return codes
+    _PA_NO_ERROR = 0
+    _PA_INVALID_DEVICE = -9996
+    _PA_INVALID_SAMPLE_RATE = -9997
+    _PA_BAD_STREAM_PTR = -9988
+    _PA_STREAM_IS_NOT_STOPPED = -9982
+
+    _ERROR_TEXT = {_PA_NO_ERROR: "Success",
+                   _PA_INVALID_DEVICE: "Invalid device",
+                   _PA_INVALID_SAMPLE_RATE: "Invalid sample rate",
+                   _PA_BAD_STREAM_PTR: "Invalid stream pointer",
+                   _PA_STREAM_IS_NOT_STOPPED: "Stream is not stopped"}
+
+    # The value returned by the callback to continue the stream
+    _PA_CONTINUE = 0
+
+    _DEVICE_NAME = "Simulated Loopback"
+
+    def __init__(self, device=None, realtime=False):
+        """ Constructor for SimulatedPortAudio object, a backend for AudioIO
+            with a single simulated loopback device.
+
+        :param device:
+            The simulated device.  If None, a device simulating a tube at
+            44.1 kHz is used.
+        :type device:
+            SimulatedDevice
+        :param realtime:
+            If True, each buffer takes as long as it would on a sound card.
+            Otherwise the buffers are processed as fast as possible, which may
+            overrun a continuous capture.
+        :type realtime:
+            bool
+        """
+        self.logger = logging.getLogger("Alpha")
+        self.logger.debug("Creating SimulatedPortAudio Object")
+
+        if device is None:
+            device = SimulatedDevice()
+        self.device = device
+        self.realtime = realtime
+
+        self.device_info = _PaDeviceInfo()
+        self.device_info.name = self._DEVICE_NAME
+        self.device_info.maxInputChannels = 2
+        self.device_info.maxOutputChannels = 2
+        self.device_info.defaultSampleRate = device.sample_rate
+
+        self.streams = {}
+        # PortAudio counts the initializations, and only terminates when each
+        # is matched by a termination
+        self.initialize_count = 0
+
+        # The functions of the PortAudio API used by AudioIO
+        for name in ["Pa_Initialize", "Pa_Terminate", "Pa_GetErrorText",
+                     "Pa_GetDeviceCount", "Pa_GetDeviceInfo",
+                     "Pa_IsFormatSupported", "Pa_OpenStream",
+                     "Pa_SetStreamFinishedCallback", "Pa_StartStream",
+                     "Pa_StopStream", "Pa_AbortStream", "Pa_CloseStream",
+                     "Pa_IsStreamActive", "Pa_Sleep"]:
+            function = getattr(self, "_" + name[3:])
+            setattr(self, name, _SimulatedFunction(function))
+
+    def _Initialize(self):
+        self.initialize_count += 1
+
+        return self._PA_NO_ERROR
+
+    def _Terminate(self):
+        self.initialize_count = max(self.initialize_count - 1, 0)
+
+        if self.initialize_count == 0:
+            for stream_id in list(self.streams):
+                self._CloseStream(stream_id)
+
+        return self._PA_NO_ERROR
+
+    def _GetErrorText(self, error):
+        return self._ERROR_TEXT.get(error, "Unknown error %s" % (error))
+
+    def _GetDeviceCount(self):
+        return 1
+
+    def _GetDeviceInfo(self, device_index):
+        if device_index != 0:
+            return POINTER(_PaDeviceInfo)()
+
+        return pointer(self.device_info)
+
+    def _IsFormatSupported(self, input_parameters, output_parameters,
+                           sample_rate):
+        for parameters in (input_parameters, output_parameters):
+            if parameters and parameters.contents.device != 0:
+                return self._PA_INVALID_DEVICE
+        if float(sample_rate) != self.device.sample_rate:
+            return self._PA_INVALID_SAMPLE_RATE
+
+        return self._PA_NO_ERROR
+
+    def _OpenStream(self, stream_pointer, input_parameters, output_parameters,
+                    sample_rate, frames_per_buffer, stream_flags, callback,
+                    user_data):
+        error = self._IsFormatSupported(input_parameters, output_parameters,
+                                        sample_rate)
+        if error != self._PA_NO_ERROR:
+            return error
+
+        if not isinstance(user_data, (int, long)):
+            user_data = addressof(user_data.contents)
+
+        stream = _SimulatedStream(float(sample_rate), frames_per_buffer,
+                                  callback, user_data)
+
+        stream_id = id(stream)
+        self.streams[stream_id] = stream
+        stream_pointer.contents.value = stream_id
+
+        return self._PA_NO_ERROR
+
+    def _SetStreamFinishedCallback(self, stream_id, callback):
+        stream = self._getStream(stream_id)
+        if stream is None:
+            return self._PA_BAD_STREAM_PTR
+
+        if isinstance(callback, c_void_p):
+            callback = CFUNCTYPE(None, c_void_p)(callback.value)
+        stream.finished_callback = callback
+
+        return self._PA_NO_ERROR
+
+    def _StartStream(self, stream_id):
+        stream = self._getStream(stream_id)
+        if stream is None:
+            return self._PA_BAD_STREAM_PTR
+        if stream.thread is not None:
+            return self._PA_STREAM_IS_NOT_STOPPED
+
+        self.device.reset()
+
+        stream.stopped.clear()
+        stream.thread = threading.Thread(target=self._runStream,
+                                         args=(stream,))
+        stream.thread.daemon = True
+        stream.thread.start()
+
+        return self._PA_NO_ERROR
+
+    def _StopStream(self, stream_id):
+        stream = self._getStream(stream_id)
+        if stream is None:
+            return self._PA_BAD_STREAM_PTR
+
+        stream.stopped.set()
+        if stream.thread is not None:
+            if stream.thread is not threading.current_thread():
+                stream.thread.join()
+            stream.thread = None
+
+        return self._PA_NO_ERROR
+
+    def _AbortStream(self, stream_id):
+        return self._StopStream(stream_id)
+
+    def _CloseStream(self, stream_id):
+        stream = self._getStream(stream_id)
+        if stream is None:
+            return self._PA_BAD_STREAM_PTR
+
+        self._StopStream(stream_id)
+        del self.streams[id(stream)]
+
+        return self._PA_NO_ERROR
+
+    def _IsStreamActive(self, stream_id):
+        stream = self._getStream(stream_id)
+        if stream is None:
+            return self._PA_BAD_STREAM_PTR
+
+        active = stream.thread is not None and stream.thread.is_alive()
+
+        return int(active)
+
+    def _Sleep(self, milliseconds):
+        time.sleep(milliseconds / 1000.0)
+
+    def _getStream(self, stream_id):
+        """ Returns the stream with the id, given as an int or a pointer. """
+        if isinstance(stream_id, c_void_p):
+            stream_id = stream_id.value
+
+        return self.streams.get(stream_id)
+
+    def _runStream(self, stream):
+        """ Runs the stream callback, feeding the buffer played in each
+            callback through the device to be recorded in the next callback,
+            until the callback completes the stream or the stream is stopped.
+
+        :param stream:
+            The stream to run.
+        :type stream:
+            _SimulatedStream
+        """
+        frame_count = stream.frames_per_buffer
+        input_buffer = (c_float * (2 * frame_count))()
+        output_buffer = (c_float * (2 * frame_count))()
+
+        input_frames = AudioIO._floatView(addressof(input_buffer),
+                                          2 * frame_count)
+        input_frames = input_frames.reshape(frame_count, 2)
+        output_frames = AudioIO._floatView(addressof(output_buffer),
+                                           2 * frame_count)
+        output_frames = output_frames.reshape(frame_count, 2)
+
+        buffer_duration = frame_count / stream.sample_rate
+        start_time = time.time()
+        buffer_index = 0
+
+        while not stream.stopped.is_set():
+            result = stream.callback(addressof(input_buffer),
+                                     addressof(output_buffer), frame_count,
+                                     None, 0, stream.user_data)
+
+            (microphone, generator) = self.device.process(output_frames[:, 0],
+                                                          output_frames[:, 1])
+            input_frames[:, 0] = microphone
+            input_frames[:, 1] = generator
+
+            if result != self._PA_CONTINUE:
+                break
+
+            buffer_index += 1
+            if self.realtime:
+                delay = start_time + buffer_index * buffer_duration
+                delay -= time.time()
+                if delay > 0:
+                    time.sleep(delay)
+
+        if stream.finished_callback is not None:
+            stream.finished_callback(None)
+
+
+if __name__ == "__main__":
+    """ Measures the throughput of a measurement, without a sound card """
+    from ConfigDb import ConfigDb
+    from Measurement import Measurement
+
+    logger = logging.getLogger("Alpha")
+    logger.setLevel(logging.INFO)
+    ch = logging.StreamHandler()
+    ch.setLevel(logging.INFO)
+    logger.addHandler(ch)
+
+    config_db = ConfigDb()
+    measurement_settings = dict(config_db.getSettings("config").items() +
+                                config_db.getSettings("signal").items() +
+                                config_db.getSettings("analysis").items())
+    measurement_settings["input device"] = 0
+    measurement_settings["output device"] = 0
+
+    sample_rate = float(measurement_settings["sample rate"])
+    device = SimulatedDevice(sample_rate, latency=0.01, noise_level=1e-4)
+    audio = AudioIO(sample_rate, SimulatedPortAudio(device))
+
+    measurement_count = 5
+    start_time = time.time()
+    for measurement_index in range(measurement_count):
+        measurement = Measurement(measurement_settings, audio=audio)
+        measurement.startMeasurement()
+    elapsed_time = time.time() - start_time
+
+    signal_duration = measurement.plan.signal_length / sample_rate
+    print "%s measurements in %.2f s, %.1f times real time" % (
+        measurement_count, elapsed_time,
+        measurement_count * signal_duration / elapsed_time)
+    print "Microphone impulse at %s, generator impulse at %s" % (
+        measurement_settings["microphone impulse location"],
+        measurement_settings["generator impulse location"])
+
+    audio.close()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+""" Runs a full exponential swept sine measurement through the simulated audio
+    backend, and both analysers.
+"""
+
+import os
+import sys
+import unittest
+
+SOURCE_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "src")
+sys.path.insert(0, SOURCE_DIRECTORY)
+
+from numpy import all, isfinite
+
+from AbsorptionCoefficient import AbsorptionCoefficient
+from AudioIO import AudioIO
+from FrequencyResponse import FrequencyResponse
+from Measurement import Measurement
+from SimulatedAudio import SimulatedDevice, SimulatedPortAudio
+
+__author__ = "Lance Jenkin"
+__email__ = "lancejenkin@gmail.com"
+
+
+class ExponentialSweepTest(unittest.TestCase):
+
+    def setUp(self):
+        # The signal generator opens the MLS database in the working directory
+        self.working_directory = os.getcwd()
+        os.chdir(SOURCE_DIRECTORY)
+
+        self.measurement_settings = {
+            "input device": 0, "output device": 0, "sample rate": 44100,
+            "fft size": 2 ** 16, "noise samples": 1000,
+            "impulse constant": 15, "impulse threshold": 0.02, "gain": 0.5,
+            "signal type": "Exponential Swept Sine", "lower frequency": 0,
+            "upper frequency": 6400, "signal length": 500 * 10 ** -3,
+            "lpf enabled": 0, "hpf enabled": 0, "pad signal": 1,
+            "signal padding": 200 * 10 ** -3,
+            "impulse delay": 20 * 10 ** -3, "signal reps": 2}
+        self.analysis_settings = {
+            "window type": "two sided", "window start": 2.8 * 10 ** -3,
+            "window end": 10 * 10 ** -3, "taper length": 0.6 * 10 ** -3,
+            "decimation factor": 5, "antialiasing filter order": 3}
+
+        device = SimulatedDevice(44100, latency=0.01, noise_level=1e-4,
+                                 seed=0)
+        self.audio = AudioIO(44100, SimulatedPortAudio(device))
+
+    def tearDown(self):
+        self.audio.close()
+        os.chdir(self.working_directory)
+
+    def testDefaultLowerFrequency(self):
+        # The default lower frequency of 0 Hz is replaced for the sweep
+        measurement = Measurement(self.measurement_settings, audio=self.audio)
+        self.assertEqual(measurement.plan.lower_frequency, 20.0)
+
+    def testMeasurement(self):
+        measurement = Measurement(self.measurement_settings, audio=self.audio)
+        measurement.startMeasurement()
+
+        # The responses are cut at different impulse locations
+        settings = measurement.measurement_settings
+        self.assertNotEqual(settings["microphone impulse location"],
+                            settings["generator impulse location"])
+
+        alpha = AbsorptionCoefficient(measurement.microphone_signals,
+                                      measurement.generator_signals,
+                                      dict(settings), self.analysis_settings)
+        self.assertTrue(all(isfinite(alpha.alpha)))
+
+        settings = dict(settings)
+        settings["window length"] = 400
+        settings["taper length"] = 50
+        frequency_response = FrequencyResponse(measurement.microphone_signals,
+                                               measurement.generator_signals,
+                                               settings)
+        self.assertEqual(len(frequency_response.frequency_response),
+                         2 ** 16)
+        self.assertTrue(all(isfinite(frequency_response.frequency_response)))
+
+
+if __name__ == "__main__":
+    unittest.main()